@@ -0,0 +1,302 @@
+"""
+Consolidated model archive. Each WW3 cycle's HTSGW, WIND and WDIR fields are appended
+to a single chunked, compressed Zarr store indexed by (cycle, lead, y, x). Chunks span
+every lead time of one cycle over a small tile of the grid, so the forecast series at a
+buoy location comes out of a single chunk read per cycle and variable, rather than a
+full decode of every grib2 file in the range.
+
+To backfill every cycle under DATA_DIR (or a range of dates) that isn't yet archived:
+    python archive.py -np 8
+    python archive.py -np 8 -s 2020-10-01 -e 2020-10-31
+
+For specific files:
+    python archive.py -f /path/to/glwu.grlc_2p5km.t07z.grib2
+
+The store can also be opened with xarray.open_zarr(ARCHIVE, consolidated=False).
+"""
+from multiprocessing import Pool
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import argparse
+import glob
+import re
+import os
+
+from configs import M2FT, MS2KT, BUOYS, DATA_DIR
+from cron_helper import logfile, locked
+log = logfile("archive.log")
+from extract import grid_fingerprint, grib_water_mask, interp_weights, weight_columns
+from extract import find_files
+import telemetry
+import grib
+
+ARCHIVE = f"{DATA_DIR}/archive.zarr"
+
+# Archived variables: name -> (eccodes shortName, conversion applied when read)
+ARCHIVE_VARS = {
+    'wvhgt': ('swh', M2FT),
+    'wspd': ('ws', MS2KT),
+    'wdir': ('wdir', 1.),
+}
+
+# Lead times 0-149 h. Chunks hold every lead of one cycle over a CHUNK x CHUNK tile.
+NLEAD = 150
+CHUNK = 32
+
+# Placeholder cycle time for slots whose cycle failed to decode
+MISSING = -1
+
+def cycle_time(filename):
+    """Model cycle of a DATA_DIR/YYYY-MM-DD/glwu.*.tHHz.grib2 file, from its path"""
+    match = re.search(r"(\d{4}-\d{2}-\d{2})/[^/]*\.t(\d{2})z\.[^/]*$", filename)
+    if match is None:
+        raise ValueError("Can't determine the cycle of %s" % (filename))
+    return datetime.strptime(match.group(1), '%Y-%m-%d') + \
+           timedelta(hours=int(match.group(2)))
+
+def to_seconds(dt):
+    return int(np.datetime64(dt, 's').astype(np.int64))
+
+def create_archive(path, filename):
+    """Create an empty store on the grid of a grib2 file"""
+    import zarr
+    from numcodecs import Blosc
+
+    lat, lon = grib.read_grid(filename)
+    mask = grib_water_mask(filename)
+    ny, nx = lat.shape
+
+    group = zarr.open_group(path, mode='w')
+    group.attrs['fingerprint'] = grid_fingerprint(lon - 360., lat)
+    for name, values in [('latitude', lat), ('longitude', lon), ('mask', mask)]:
+        arr = group.array(name, values, chunks=values.shape)
+        arr.attrs['_ARRAY_DIMENSIONS'] = ['y', 'x']
+    lead = group.array('lead', np.arange(NLEAD, dtype=np.int32))
+    lead.attrs.update({'_ARRAY_DIMENSIONS': ['lead'], 'units': 'hours'})
+    cycle = group.create('cycle', shape=(0,), chunks=(1024,), dtype=np.int64,
+                         fill_value=MISSING)
+    cycle.attrs.update({'_ARRAY_DIMENSIONS': ['cycle'],
+                        'units': 'seconds since 1970-01-01', 'calendar': 'standard'})
+
+    compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+    for var in ARCHIVE_VARS:
+        arr = group.create(var, shape=(0, NLEAD, ny, nx),
+                           chunks=(1, NLEAD, CHUNK, CHUNK), dtype=np.float32,
+                           fill_value=np.nan, compressor=compressor)
+        arr.attrs['_ARRAY_DIMENSIONS'] = ['cycle', 'lead', 'y', 'x']
+    return group
+
+def open_archive(path=None, mode='r'):
+    """Open the store as a zarr group"""
+    import zarr
+    return zarr.open_group(path or ARCHIVE, mode=mode)
+
+def archived_cycles(group):
+    """Row of each committed cycle in the store, keyed on cycle time (seconds)"""
+    times = group['cycle'][:]
+    return dict((int(t), row) for row, t in enumerate(times) if t != MISSING)
+
+def write_cycle(task):
+    """Decode a grib2 file into its preallocated row of the store, one variable at a
+    time. Safe to map across a multiprocessing.Pool: each row is its own set of chunks.
+
+    Returns
+    -------
+    row : int
+        The row written
+    ok : bool
+        False if the file couldn't be decoded or is on a different grid
+    """
+    path, row, filename = task
+    try:
+        group = open_archive(path, mode='r+')
+        lat, lon = grib.read_grid(filename)
+        if grid_fingerprint(lon - 360., lat) != group.attrs['fingerprint']:
+            raise ValueError("grid differs from the archive")
+        data = grib.read_grib(filename, [name for name, _ in ARCHIVE_VARS.values()])
+        lead = ((data['time'] - data['runtime']) // np.timedelta64(1, 'h')).astype(int)
+        keep = (lead >= 0) & (lead < NLEAD)
+
+        for var, (name, scale) in ARCHIVE_VARS.items():
+            values = np.full(group[var].shape[1:], np.nan, dtype=np.float32)
+            values[lead[keep]] = data[name][keep]
+            group[var][row] = values
+    except Exception as e:
+        log.error("Failed to archive %s: %s" % (filename, e))
+        return row, False
+    log.info("Archived %s" % (filename))
+    return row, True
+
+@telemetry.stage('archive')
+def append_cycles(files, path=None, pool=None):
+    """Append any cycles not yet in the store. Rows for the new cycles are allocated
+    up front, filled (in parallel if a pool is given), and only then committed by
+    writing their cycle times, so readers never see a partially written cycle.
+
+    Parameters
+    ----------
+    files : list
+        WW3 grib2 files
+    path : str, optional
+        Location of the store. Default: ARCHIVE
+    pool : multiprocessing.Pool, optional
+        Pool to decode the files with. Serial if not provided.
+
+    Returns
+    -------
+    appended : list
+        Files that were archived
+    """
+    path = path or ARCHIVE
+    if not files:
+        return []
+    # Exclusive lock so run.py and a backfill never append to the store at once
+    with locked(path + '.lock'):
+        if not os.path.exists(path):
+            create_archive(path, files[0])
+        group = open_archive(path, mode='r+')
+        existing = archived_cycles(group)
+
+        # Drop any rows left allocated by an interrupted append
+        nrow = group['cycle'].shape[0]
+        for var in ARCHIVE_VARS:
+            group[var].resize(nrow, *group[var].shape[1:])
+
+        new = {}
+        for f in files:
+            t = to_seconds(cycle_time(f))
+            if t not in existing:
+                new[t] = f
+        if not new:
+            return []
+
+        times = sorted(new)
+        for var in ARCHIVE_VARS:
+            group[var].resize(nrow + len(times), *group[var].shape[1:])
+
+        tasks = [(path, nrow + n, new[t]) for n, t in enumerate(times)]
+        if pool is not None:
+            results = pool.map(write_cycle, tasks, chunksize=1)
+        else:
+            results = [write_cycle(task) for task in tasks]
+
+        committed = np.array([t if ok else MISSING for t, (row, ok) in zip(times,
+                              results)], dtype=np.int64)
+        group['cycle'].append(committed)
+
+    appended = [new[t] for t, (row, ok) in zip(times, results) if ok]
+    telemetry.count('cycles_archived', len(appended))
+    return appended
+
+def load_cycles(start, end, buoys=BUOYS, fhr=None, path=None):
+    """Read the model series at each buoy for every archived cycle from the date of
+    start through the date of end (as with extract.find_files), in the same form as
+    extract.load_points.
+
+    Parameters
+    ----------
+    start, end : datetime
+        Range of dates
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    fhr : int, optional
+        Number of forecast hours to return. Default is every lead time.
+    path : str, optional
+        Location of the store. Default: ARCHIVE
+
+    Returns
+    -------
+    arr : list
+        One dictionary per cycle, oldest first. See extract.read_points.
+    """
+    group = open_archive(path)
+    cycles = archived_cycles(group)
+    t0 = to_seconds(np.datetime64(start, 'D'))
+    t1 = to_seconds(np.datetime64(end, 'D') + np.timedelta64(1, 'D'))
+    times = sorted(t for t in cycles if t0 <= t < t1)
+    if not times:
+        return []
+    rows = [cycles[t] for t in times]
+    nlead = min(fhr or NLEAD, NLEAD)
+
+    # Interpolation weights over the water points of the grid. Stores created before
+    # the mask was kept fall back to the wave heights of their first cycle.
+    lat = group['latitude'][:]
+    if 'mask' in group:
+        mask = group['mask'][:]
+    else:
+        mask = ~np.isnan(group['wvhgt'][rows[0], 0])
+    cols, weights = weight_columns(interp_weights(group['longitude'][:] - 360., lat,
+                                                  mask, buoys))
+    j, i = np.unravel_index(cols, lat.shape)
+
+    # Grid points grouped by the chunk tile they fall in, so each chunk is only read
+    # once per cycle and variable, however many points and stations share it
+    tiles = {}
+    chunks = group['wvhgt'].chunks[2:]
+    for n, (jj, ii) in enumerate(zip(j, i)):
+        tiles.setdefault((jj // chunks[0], ii // chunks[1]), []).append(n)
+
+    series = {}
+    for var, (name, scale) in ARCHIVE_VARS.items():
+        # (point, cycle * lead) values at every grid point used by the weights
+        values = np.empty((len(cols), len(rows) * nlead), dtype=np.float32)
+        for points in tiles.values():
+            jsel, isel = np.unique(j[points]), np.unique(i[points])
+            block = group[var].get_orthogonal_selection((rows, slice(0, nlead), jsel,
+                                                         isel))
+            for n in points:
+                values[n] = block[:, :, np.searchsorted(jsel, j[n]),
+                                  np.searchsorted(isel, i[n])].ravel()
+        if var == 'wdir':
+            # Directions are interpolated as unit vectors
+            rad = np.deg2rad(values)
+            out = np.rad2deg(np.arctan2(weights @ np.sin(rad), weights @ np.cos(rad)))
+            out = out % 360.
+        else:
+            out = weights @ values * scale
+        out = out.astype(np.float32).reshape(len(buoys), len(rows), nlead)
+        series[var] = dict(zip(buoys, out))
+
+    arr = []
+    lead = pd.to_timedelta(np.arange(nlead), unit='h')
+    for n, t in enumerate(times):
+        runtime = pd.Timestamp(t, unit='s')
+        data = {'time': runtime + lead, 'runtime': runtime}
+        for var in ARCHIVE_VARS:
+            data[var] = dict((stn_id, values[n]) for stn_id, values in
+                             series[var].items())
+        arr.append(data)
+    return arr
+
+def backfill_files(start=None, end=None):
+    """Every grib2 file under DATA_DIR, or those between two dates"""
+    if start is not None or end is not None:
+        return find_files(start or datetime(1970, 1, 1), end or datetime.utcnow())
+    return sorted(glob.glob("%s/*/*.grib2" % (DATA_DIR)))
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-f', '--files', dest="files", nargs="+",
+                    help="grib2 files to archive. Default: everything under DATA_DIR")
+    ap.add_argument('-s', '--start', dest="start", help="YYYY-MM-DD")
+    ap.add_argument('-e', '--end', dest="end", help="YYYY-MM-DD")
+    ap.add_argument('-np', '--nproc', dest='nproc', type=int,
+                    help="Number of processes to decode grib2 files with")
+    args = ap.parse_args()
+
+    if args.files:
+        files = args.files
+    else:
+        parse = lambda s: datetime.strptime(s, '%Y-%m-%d') if s else None
+        files = backfill_files(parse(args.start), parse(args.end))
+
+    telemetry.init('archive')
+    if args.nproc:
+        with Pool(args.nproc) as pool:
+            appended = append_cycles(files, pool=pool)
+    else:
+        appended = append_cycles(files)
+    log.info("Archived %d of %d files" % (len(appended), len(files)))
+    telemetry.flush()
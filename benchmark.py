@@ -0,0 +1,329 @@
+"""
+Benchmarks for each stage of the plotting pipeline. Synthetic GLWU-shaped GRIB2 cycles
+(Lambert conformal, 2.5 km, HTSGW/WIND/WDIR) and NDBC realtime2 text files are written
+to a temporary directory, and each stage is timed and memory-profiled separately.
+Results are written as JSON so runs can be compared between commits.
+
+    python benchmark.py -o bench.json
+    python benchmark.py --cycles 10 --fhr 149 --stations 30 --nx 400 --ny 300
+    python benchmark.py -o new.json --compare bench.json
+
+Requires eccodes to write the synthetic GRIB2 files.
+"""
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import xarray as xr
+from datetime import datetime, timedelta
+import http.client
+import subprocess
+import threading
+import statistics
+import tracemalloc
+import resource
+import argparse
+import platform
+import tempfile
+import shutil
+import json
+import time
+import os
+
+from configs import BUOYS
+import extract
+import archive
+import ndbc
+import plots
+import server
+
+SCRIPT_PATH = os.path.dirname(__file__) or "."
+
+# Synthetic grid, roughly centred on southern Lake Michigan
+LAT0 = 41.3
+LON0 = 271.8
+GRID_SPACING = 2500
+
+# Requests per call of the server_requests stage
+HTTP_REQUESTS = 1000
+
+# (discipline, parameterCategory, parameterNumber) of HTSGW, WIND and WDIR
+GRIB_PARAMS = [(10, 0, 3), (0, 2, 1), (0, 2, 0)]
+
+NDBC_HEADER = (
+    "#YY  MM DD hh mm WDIR WSPD GST  WVHT   DPD   APD MWD   PRES  ATMP  WTMP  DEWP  VIS PTDY  TIDE\n"
+    "#yr  mo dy hr mn degT m/s  m/s     m   sec   sec degT   hPa  degC  degC  degC  nmi  hPa    ft\n"
+)
+
+def write_cycle(fname, runtime, fhr, nx, ny, rng):
+    """Write a synthetic GLWU cycle with fhr+1 hourly steps of HTSGW, WIND and WDIR"""
+    import eccodes
+
+    with open(fname, 'wb') as f:
+        for step in range(fhr + 1):
+            for discipline, category, number in GRIB_PARAMS:
+                gid = eccodes.codes_grib_new_from_samples('GRIB2')
+                eccodes.codes_set(gid, 'gridDefinitionTemplateNumber', 30)
+                grid = {
+                    'Nx': nx, 'Ny': ny, 'shapeOfTheEarth': 6,
+                    'latitudeOfFirstGridPointInDegrees': LAT0,
+                    'longitudeOfFirstGridPointInDegrees': LON0,
+                    'LaDInDegrees': 25.0, 'LoVInDegrees': 265.0,
+                    'Latin1InDegrees': 25.0, 'Latin2InDegrees': 25.0,
+                    'DxInMetres': GRID_SPACING, 'DyInMetres': GRID_SPACING,
+                    'discipline': discipline, 'parameterCategory': category,
+                    'parameterNumber': number, 'typeOfFirstFixedSurface': 1,
+                    'dataDate': int(runtime.strftime('%Y%m%d')),
+                    'dataTime': runtime.hour * 100, 'forecastTime': step,
+                    'bitmapPresent': 1, 'missingValue': 9999,
+                }
+                for key, value in grid.items():
+                    eccodes.codes_set(gid, key, value)
+
+                values = rng.random(nx * ny) * (360. if number == 0 else 5.)
+                values[0:nx] = 9999
+                eccodes.codes_set_values(gid, values)
+                eccodes.codes_write(gid, f)
+                eccodes.codes_release(gid)
+
+def write_buoy(fname, end, days, rng):
+    """Write a synthetic realtime2 file with 10-minute observations, newest first"""
+    rows = []
+    nobs = days * 144
+    for n in range(nobs):
+        t = end - timedelta(minutes=10*n)
+        wvht = "%5.2f" % (rng.random() * 3) if n % 3 == 0 else "   MM"
+        rows.append("%s %3d %4.1f %4.1f %s    MM    MM  MM 1015.5  12.3  14.1   8.5   MM"
+                    "   MM    MM" % (t.strftime('%Y %m %d %H %M'), rng.integers(0, 360),
+                                     rng.random() * 10, rng.random() * 12, wvht))
+    with open(fname, 'w') as f:
+        f.write(NDBC_HEADER + "\n".join(rows) + "\n")
+
+def make_fixtures(data_dir, cycles, fhr, stations, nx, ny, days=45, seed=0):
+    """Write synthetic cycles and buoy files to data_dir.
+
+    Returns
+    -------
+    files : list
+        GRIB2 files, oldest cycle first
+    buoys : dict
+        Synthetic buoy metadata in the form of configs.BUOYS
+    end : datetime
+        Time of the latest cycle
+    """
+    rng = np.random.default_rng(seed)
+    end = datetime(2020, 10, 11, 7)
+    files = []
+    for n in range(cycles):
+        runtime = end - timedelta(hours=12*(cycles-n-1))
+        path = "%s/%s" % (data_dir, runtime.strftime('%Y-%m-%d'))
+        os.makedirs(path, exist_ok=True)
+        fname = "%s/glwu.grlc_2p5km.t%02dz.grib2" % (path, runtime.hour)
+        write_cycle(fname, runtime, fhr, nx, ny, rng)
+        files.append(fname)
+
+    # Stations scattered across the interior of the grid
+    with xr.open_dataset(files[0], engine='cfgrib') as ds:
+        lats = ds.latitude.values[1:-1, 1:-1]
+        lons = ds.longitude.values[1:-1, 1:-1] - 360.
+    buoys = {}
+    for n in range(stations):
+        j, i = rng.integers(0, lats.shape[0]), rng.integers(0, lats.shape[1])
+        stn_id = "SYN%03d" % (n)
+        buoys[stn_id] = [round(float(lats[j, i]), 3), round(float(lons[j, i]), 3),
+                         float(rng.choice([1., 3., 10., 20.]))]
+        write_buoy("%s/%s.txt" % (data_dir, stn_id), end, days, rng)
+    return files, buoys, end
+
+def measure(func, repeat=1):
+    """Time func over repeat calls, and measure peak traced memory of a single call.
+    If func returns a float, that is used as the elapsed time of the call.
+    """
+    seconds = []
+    for n in range(repeat):
+        t0 = time.perf_counter()
+        elapsed = func()
+        if not isinstance(elapsed, float):
+            elapsed = time.perf_counter() - t0
+        seconds.append(elapsed)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'median': statistics.median(seconds),
+        'peak_mb': peak / 1024. ** 2,
+    }
+
+def run_benchmarks(cycles=4, fhr=84, stations=5, nx=100, ny=110, repeat=3):
+    """Run every stage benchmark against freshly generated fixtures.
+
+    Returns
+    -------
+    results : dict
+        Per-stage timing and memory results, plus run metadata
+    """
+    results = {}
+    data_dir = tempfile.mkdtemp(prefix="ww3_bench_")
+    plot_dir = tempfile.mkdtemp(prefix="ww3_bench_images_")
+    weights_file, grib_dir = extract.INTERP_WEIGHTS, extract.DATA_DIR
+    extract.INTERP_WEIGHTS = "%s/interp_weights.npz" % (data_dir)
+    # find_files globs the cycles within extract.DATA_DIR
+    extract.DATA_DIR = data_dir
+    try:
+        t0 = time.perf_counter()
+        files, buoys, end = make_fixtures(data_dir, cycles, fhr, stations, nx, ny)
+        fixture_time = time.perf_counter() - t0
+
+        # read_buoy_data looks up anemometer heights in the shared BUOYS dictionary
+        BUOYS.update(buoys)
+
+        # Grid and fields of the first cycle, for the interpolation stages
+        ww3 = extract.read_ww3_data(files[0])
+        points = [[buoys[stn_id][1], buoys[stn_id][0]] for stn_id in buoys]
+
+        results['read_ww3_data'] = measure(lambda: extract.read_ww3_data(files[-1]),
+                                           repeat)
+        valid = ~np.isnan(ww3['wvhgt'][0])
+        results['nearest_idx'] = measure(
+            lambda: extract.nearest_idx(points, ww3['lons'], ww3['lats']), repeat)
+        results['idw_weights'] = measure(
+            lambda: extract.idw_weights(points, ww3['lons'], ww3['lats'], valid), repeat)
+        results['extract_points'] = measure(
+            lambda: extract.extract_points(files[-1], buoys), repeat)
+        results['read_points'] = measure(
+            lambda: [extract.read_points(f, buoys) for f in files], repeat)
+        results['stream_points'] = measure(
+            lambda: sum(1 for f, data in extract.stream_points(files, buoys)), repeat)
+
+        # Consolidated archive: appending every cycle to a fresh store, and reading
+        # the buoy-point series of every cycle back out of it
+        stores = []
+        def append():
+            stores.append("%s/archive%d.zarr" % (data_dir, len(stores)))
+            archive.append_cycles(files, stores[-1])
+        results['archive_append'] = measure(append, repeat)
+        results['load_cycles'] = measure(
+            lambda: archive.load_cycles(end - timedelta(days=cycles), end, buoys,
+                                        path=stores[-1]), repeat)
+
+        def parse_buoys():
+            # Full parse, starting without any stored observations
+            ndbc._stores.clear()
+            for stn_id in buoys:
+                store = ndbc.store_name(data_dir, stn_id)
+                if os.path.exists(store): os.remove(store)
+                plots.read_buoy_data(data_dir, stn_id)
+        results['read_buoy_data'] = measure(parse_buoys, repeat)
+        results['read_buoy_data_cached'] = measure(
+            lambda: [plots.read_buoy_data(data_dir, stn_id) for stn_id in buoys], repeat)
+
+        # Rendering. Artist updates and image output (one draw, then every one of
+        # IMAGE_OUTPUTS) are timed separately.
+        arr = [extract.load_points(f, buoys, fhr=fhr) for f in files]
+        start = end - timedelta(days=cycles // 2 + 1)
+        tasks = []
+        for stn_id in buoys:
+            series = [(d['time'], d['wvhgt'][stn_id], d['wspd'][stn_id]) for d in arr]
+            tasks.append((stn_id, series, plots.read_buoy_data(data_dir, stn_id, start)))
+        figure = plots.StationFigure()
+
+        def render():
+            for stn_id, series, buoy_data in tasks:
+                figure.draw(series, buoy_data, start, end, end)
+        def savefig():
+            elapsed = 0.
+            for stn_id, series, buoy_data in tasks:
+                figure.draw(series, buoy_data, start, end, end)
+                t0 = time.perf_counter()
+                pixels = plots.rasterize(figure.fig, plots.PLOT_DPI, tight=True)
+                futures = plots.save_outputs(pixels, "%s/%s" % (plot_dir, stn_id))
+                [future.result() for future in futures]
+                elapsed += time.perf_counter() - t0
+            return elapsed
+        results['render'] = measure(render, repeat)
+        results['savefig'] = measure(savefig, repeat)
+
+        # Local HTTP service: building every response, then HTTP_REQUESTS gzipped
+        # requests for a station's model series over one keep-alive connection
+        service = server.Service(data_dir, plot_dir, "%s/plume.npz" % (data_dir),
+                                 days=cycles // 2 + 1, buoys=buoys)
+        def build():
+            service.fingerprint = None
+            service.refresh(now=end)
+        results['server_build'] = measure(build, repeat)
+        httpd = server.serve(service, '127.0.0.1', 0)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        path = "/stations/%s/model.json" % (next(iter(buoys)))
+        def get_series():
+            conn = http.client.HTTPConnection(*httpd.server_address)
+            for n in range(HTTP_REQUESTS):
+                conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                conn.getresponse().read()
+            conn.close()
+        results['server_requests'] = measure(get_series, repeat)
+        httpd.shutdown()
+        httpd.server_close()
+    finally:
+        extract.INTERP_WEIGHTS, extract.DATA_DIR = weights_file, grib_dir
+        for stn_id in [k for k in BUOYS if k.startswith("SYN")]:
+            del BUOYS[stn_id]
+        shutil.rmtree(data_dir, ignore_errors=True)
+        shutil.rmtree(plot_dir, ignore_errors=True)
+
+    try:
+        commit = subprocess.check_output(['git', '-C', SCRIPT_PATH, 'rev-parse',
+                                          'HEAD'], stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'meta': {
+            'time': datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'params': {'cycles': cycles, 'fhr': fhr, 'stations': stations, 'nx': nx,
+                       'ny': ny, 'repeat': repeat},
+            'fixture_seconds': fixture_time,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        },
+        'results': results,
+    }
+
+def compare(new, old):
+    """Print the change in median time and peak memory of each stage"""
+    print("%-24s %10s %10s %8s %10s %10s" % ("stage", "old (s)", "new (s)", "ratio",
+                                            "old (MB)", "new (MB)"))
+    for stage, result in new['results'].items():
+        if stage not in old['results']:
+            continue
+        prev = old['results'][stage]
+        ratio = result['median'] / prev['median'] if prev['median'] else float('nan')
+        print("%-24s %10.4f %10.4f %8.2f %10.1f %10.1f" % (stage, prev['median'],
+              result['median'], ratio, prev['peak_mb'], result['peak_mb']))
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--cycles', type=int, default=4, help="Number of model cycles")
+    ap.add_argument('--fhr', type=int, default=84, help="Forecast hours per cycle")
+    ap.add_argument('--stations', type=int, default=5, help="Number of buoys")
+    ap.add_argument('--nx', type=int, default=100, help="Grid points in x")
+    ap.add_argument('--ny', type=int, default=110, help="Grid points in y")
+    ap.add_argument('--repeat', type=int, default=3, help="Timed calls per stage")
+    ap.add_argument('-o', '--output', dest='output', help="Write results to this file")
+    ap.add_argument('--compare', dest='compare', help="Earlier results to compare to")
+    args = ap.parse_args()
+
+    bench = run_benchmarks(args.cycles, args.fhr, args.stations, args.nx, args.ny,
+                           args.repeat)
+    for stage, result in bench['results'].items():
+        print("%-24s %10.4f s %10.1f MB" % (stage, result['median'], result['peak_mb']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(bench, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(bench, json.load(f))
@@ -50,10 +50,23 @@ BUOYS = {
 }
 
 # Variables for automated WW3 downloads.
-# SLEEP_TIME : number of seconds to sleep between download calls for ww3 data
+# SLEEP_TIME : maximum number of seconds to sleep between polls for ww3 data
 # TIME_LIMIT : number of hours to try and download data before exiting
+# DOWNLOAD_THREADS : number of concurrent byte-range requests per GRIB2 download
+# CYCLE_HOURS : GLWU cycles (UTC) to download
+# RETENTION_DAYS : days of cycles kept on NOMADS, scanned for missing cycles
+# MAX_CYCLES : number of cycles downloaded at once when backfilling
+# MAX_CONNECTIONS : total concurrent connections to NOMADS
+# MAX_REQUESTS : requests per second to NOMADS, which blocks clients making more
+#                than about 120 requests a minute
 SLEEP_TIME = 120
 TIME_LIMIT = 2
+DOWNLOAD_THREADS = 4
+CYCLE_HOURS = [7, 19]
+RETENTION_DAYS = 2
+MAX_CYCLES = 2
+MAX_CONNECTIONS = 8
+MAX_REQUESTS = 2
 
 # ======================================================================================
 # Plotting configurations.
@@ -72,6 +85,29 @@ buoy_prop = {'marker': 'o', 's': 5, 'c': 'r', 'linewidths': 2, 'zorder': 99}
 raw_buoy_prop = {'marker': 's', 's': 3, 'c': 'b', 'linewidths': 1, 'zorder': 4}
 barb_prop = {'color': '#84fa75', 'width': 0.0008, 'headwidth': 5, 'scale': 65,
              'headlength': 8, 'headaxislength': 6, 'zorder': 3}
+# Shaded min-max band of the forecast plume (see plume.py)
+plume_prop = {'color': '#9575cd', 'alpha': 0.35, 'linewidth': 0, 'zorder': 0}
+
+# Lake-wide maps (plots.py --map): wave height shading, wind vectors at every
+# MAP_STRIDE grid points and observed wave heights, one frame per forecast hour
+map_prop = {'cmap': 'viridis', 'vmin': 0, 'vmax': 20}
+map_vector_prop = {'color': 'white', 'scale': 600, 'width': 0.0015, 'zorder': 3}
+map_obs_prop = {'s': 60, 'edgecolors': 'r', 'linewidths': 1.5, 'zorder': 4}
+MAP_STRIDE = 8
+MAP_DPI = 100
+MAP_FRAME_MS = 250
+
+# Images saved from each station plot. The figure is drawn once at PLOT_DPI and cropped
+# to its content, and every output is encoded from that single image: a filename
+# suffix, the width in pixels (None for full size), the format (png or webp) and, for
+# png, the number of palette colors (None for full color). Any other keys are passed to
+# Pillow's save, e.g. compress_level for png or quality for webp.
+PLOT_DPI = 250
+IMAGE_OUTPUTS = [
+    {'suffix': '', 'width': None, 'format': 'png', 'colors': 256, 'compress_level': 6},
+    {'suffix': '_small', 'width': 1600, 'format': 'webp', 'quality': 80},
+    {'suffix': '_thumb', 'width': 400, 'format': 'webp', 'quality': 80},
+]
 
 # WW3 forecast hours to plot (max=149)
 FHR = 84
@@ -79,11 +115,35 @@ FHR = 84
 # Number of days of WW3 in the past to plot
 NUM_DAYS = 5
 
+# Granularity (minutes) of the vertical "NOW" reference line. Stations are only
+# re-rendered when their buoy or model data change, or the NOW line moves.
+NOW_GRANULARITY = 60
+
+# Streaming mode (plots.py --stream) for long date ranges. At most STREAM_WINDOW grib2
+# files are decoded at once, fewer if the decoding processes would otherwise use more
+# than MEMORY_LIMIT MB between them.
+STREAM_WINDOW = 4
+MEMORY_LIMIT = 4096
+
 # ======================================================================================
 # Likely no need for editing below this line
 # ======================================================================================
+# Number of concurrent NDBC downloads
+BUOY_THREADS = 8
+
+# Seconds between run.py's checks for new buoy observations and new WW3 cycles
+BUOY_POLL = 120
+WW3_POLL = 60
+
+# Local HTTP service (server.py): address to listen on, and seconds between its checks
+# for new cycles, buoy observations and images
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 8050
+HTTP_POLL = 30
+
 # Data URLs
 BUOY_URL = "https://www.ndbc.noaa.gov/data/realtime2/"
+HISTORY_URL = "https://www.ndbc.noaa.gov/data/historical/stdmet/"
 REALTIME_URL = "https://nomads.ncep.noaa.gov/pub/data/nccf/com/glwu/prod/glwu."
 
 # Data variables we want from the wave model
@@ -1,5 +1,7 @@
+from contextlib import contextmanager
 from datetime import datetime
 import logging
+import fcntl
 import os
 SCRIPT_PATH = os.path.dirname(__file__) or "."
 
@@ -9,9 +11,36 @@ def timestamp(str1, str2):
     print("%s  %s : %s" % (str1, datetime.strftime(datetime.now(), "%c"), str2))
 
 def logfile(logname):
-    logging.basicConfig(filename="%s/%s" % (f"{SCRIPT_PATH}/logs", logname),
-                        format='%(levelname)s %(asctime)s :: %(message)s',
-                        datefmt="%Y-%m-%d %H:%M:%S")
-    log = logging.getLogger()
-    log.setLevel(logging.INFO)
+    """Logger writing to logs/<logname>. Each log file gets its own logger, so modules
+    imported into one process (as in run.py) still write to their own files.
+    """
+    log = logging.getLogger(logname)
+    if not log.handlers:
+        handler = logging.FileHandler("%s/%s" % (f"{SCRIPT_PATH}/logs", logname),
+                                      delay=True)
+        handler.setFormatter(logging.Formatter(
+            '%(levelname)s %(asctime)s :: %(message)s', datefmt="%Y-%m-%d %H:%M:%S"))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        log.propagate = False
     return log
+
+@contextmanager
+def locked(path, blocking=True):
+    """Exclusive flock on path, held across processes until the block exits. With
+    blocking=False, yields False straight away if another process holds the lock.
+    """
+    with open(path, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def lockfile(name, blocking=True):
+    """Exclusive lock on logs/<name>.lock (see locked)"""
+    return locked("%s/%s.lock" % (f"{SCRIPT_PATH}/logs", name), blocking)
@@ -0,0 +1,476 @@
+"""
+Point extraction for WW3 model cycles. Pulls the forecast time series at each of the
+BUOYS locations out of a downloaded grib2 file and stores them in a small sidecar file
+next to the grib2 data, so the plotting routines don't have to decode the full grids
+every 30 minutes. Model data only changes twice a day.
+
+To extract any new (or stale) cycles within the last NUM_DAYS days:
+    python extract.py
+
+For specific files:
+    python extract.py -f /path/to/glwu.grlc_2p5km.t07z.grib2
+"""
+import numpy as np
+from scipy import spatial, sparse
+import pandas as pd
+from datetime import datetime, timedelta
+from collections import deque
+import argparse
+from glob import glob
+import tempfile
+import hashlib
+import os
+
+from configs import M2FT, MS2KT, BUOYS, DATA_DIR, NUM_DAYS
+from configs import STREAM_WINDOW, MEMORY_LIMIT
+from cron_helper import logfile
+log = logfile("plots.log")
+import telemetry
+import grib
+
+SIDECAR_EXT = ".points.npz"
+INTERP_WEIGHTS = f"{DATA_DIR}/interp_weights.npz"
+
+# Bumped when the way series are extracted changes, so older sidecars are re-extracted
+SIDECAR_VERSION = 2
+
+# Inverse-distance weighting over the NEIGHBORS nearest water points. Buoys more than
+# MAX_DISTANCE km from any water point are logged.
+NEIGHBORS = 4
+IDW_POWER = 2
+MAX_DISTANCE = 10
+KM_PER_DEGREE = 111.2
+
+# Interpolation weights already loaded in this process, keyed on grid fingerprint
+_weights = {}
+
+# Buoy-point series already loaded in this process, keyed on (filename, fhr). Lets a
+# long-running process (run.py) skip even the sidecar reads between jobs.
+_points = {}
+
+def read_ww3_data(filename, fhr=None):
+    """Read Wave Watch III grib2 data. Only the wave height and wind speed messages of
+    the first fhr forecast hours are decoded (see grib.read_grib).
+    """
+    log.info(f"Reading: {filename}")
+
+    lat, lon = grib.read_grid(filename)
+    ds = grib.read_grib(filename, ['swh', 'ws'], fhr)
+    data = {
+        'lons': lon - 360.,
+        'lats': lat,
+        'wvhgt': ds['swh'] * M2FT,
+        'wspd': ds['ws'] * MS2KT,
+        'time': pd.to_datetime(ds['time']),
+        'runtime': pd.to_datetime(ds['runtime'])
+    }
+    return data
+
+def nearest_idx(points, lon, lat):
+    """Search for the nearest grid point using a KDTree
+
+    Parameters
+    ----------
+    points : list
+        List of lists indicating lon/lat pais: [[LON1, LAT1], [LON2, LAT2]]
+    lat : np.array
+        2-d array of gridded latitudes
+    lon : np.arrat
+        2-d array of gridded longitudes
+    """
+
+    lonlat = np.column_stack((lon.ravel(), lat.ravel()))
+    tree = spatial.cKDTree(lonlat)
+    dist, idx = tree.query(points, k=1)
+    ind = np.column_stack(np.unravel_index(idx, lon.shape))
+    return [(j,i) for j,i in ind]
+
+def grid_fingerprint(lon, lat, valid=None):
+    """Hash of the grid shape and coordinates, and of the water mask if given. The
+    GLWU grid is fixed, so this only changes if NCEP alters the model domain (or the
+    mask, e.g. for ice cover).
+    """
+    h = hashlib.sha1()
+    h.update(np.asarray(lon.shape).tobytes())
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    if valid is not None:
+        h.update(np.packbits(valid).tobytes())
+    return h.hexdigest()
+
+def grib_water_mask(filename, messages=None):
+    """Grid points with valid (non-NaN) wave heights in the first step of a grib2 file,
+    decoding only that message
+    """
+    return ~np.isnan(grib.read_grib(filename, ['swh'], 1, messages=messages)['swh'][0])
+
+def idw_weights(points, lon, lat, valid):
+    """Inverse-distance weights of the NEIGHBORS nearest water points to each point.
+
+    Parameters
+    ----------
+    points : list
+        List of lists indicating lon/lat pairs: [[LON1, LAT1], [LON2, LAT2]]
+    lon, lat : np.array
+        2-d arrays of gridded longitudes and latitudes
+    valid : np.array
+        2-d boolean array, True at water points
+
+    Returns
+    -------
+    cols : np.array
+        (npoints, NEIGHBORS) flattened grid indices of the neighbours
+    weights : np.array
+        (npoints, NEIGHBORS) weights, summing to 1 for each point
+    """
+    water = np.flatnonzero(valid.ravel())
+    # Scale longitudes so distances are roughly isotropic at these latitudes
+    scale = np.cos(np.deg2rad(np.mean(lat)))
+    xy = np.column_stack((lon.ravel()[water] * scale, lat.ravel()[water]))
+    points = np.asarray(points, dtype=np.float64) * [scale, 1.]
+
+    tree = spatial.cKDTree(xy)
+    dist, idx = tree.query(points, k=min(NEIGHBORS, len(water)))
+    dist, idx = dist.reshape(len(points), -1), idx.reshape(len(points), -1)
+    weights = 1. / np.maximum(dist, 1e-9) ** IDW_POWER
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    far = dist[:, 0] * KM_PER_DEGREE > MAX_DISTANCE
+    for point in np.asarray(points)[far]:
+        log.warning("Nearest water point to %.3f, %.3f is over %d km away" %
+                    (point[1], point[0] / scale, MAX_DISTANCE))
+    return water[idx], weights
+
+def interp_weights(lon, lat, valid, buoys=BUOYS, cache_file=None):
+    """Sparse matrix interpolating a flattened grid to each of the buoys. Only water
+    points are used, so buoys close to shore don't pick up masked land values. Weights
+    come from a persistent cache keyed on the grid and water-mask fingerprint, and are
+    only computed for stations not already in the cache.
+
+    Parameters
+    ----------
+    lon : np.array
+        2-d array of gridded longitudes
+    lat : np.array
+        2-d array of gridded latitudes
+    valid : np.array
+        2-d boolean array, True at water points. See grib_water_mask.
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    cache_file : str, optional
+        Location of the on-disk weights cache. Default: INTERP_WEIGHTS
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        (number of buoys, number of grid points). weights @ values.reshape(-1, ny*nx).T
+        gives the (station, time) series.
+    """
+    cache_file = cache_file or INTERP_WEIGHTS
+    fingerprint = grid_fingerprint(lon, lat, valid)
+    cached = _weights.get(fingerprint)
+    if cached is None:
+        cached = {}
+        try:
+            with np.load(cache_file, allow_pickle=False) as npz:
+                if str(npz['fingerprint']) == fingerprint:
+                    cached = dict(zip(npz['keys'], zip(npz['cols'], npz['weights'])))
+        except (OSError, KeyError, ValueError):
+            pass
+
+    keys = [station_key(*buoys[stn_id][0:2]) for stn_id in buoys]
+    missing = [key for key in dict.fromkeys(keys) if key not in cached]
+    if missing:
+        log.info(f"Computing interpolation weights for {len(missing)} stations")
+        points = [[buoys[stn_id][1], buoys[stn_id][0]] for stn_id in buoys]
+        points = dict(zip(keys, points))
+        cols, weights = idw_weights([points[key] for key in missing], lon, lat, valid)
+        cached.update(zip(missing, zip(cols, weights)))
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file) or ".",
+                                   suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, fingerprint=np.array(fingerprint), keys=np.array(list(cached)),
+                     cols=np.array([c for c, w in cached.values()], dtype=np.int64),
+                     weights=np.array([w for c, w in cached.values()]))
+        os.replace(tmp, cache_file)
+    _weights[fingerprint] = cached
+
+    cols = np.array([cached[key][0] for key in keys], dtype=np.int64)
+    weights = np.array([cached[key][1] for key in keys])
+    rows = np.repeat(np.arange(len(keys)), cols.shape[1] if cols.size else 0)
+    return sparse.csr_matrix((weights.ravel(), (rows, cols.ravel())),
+                             shape=(len(keys), lon.size))
+
+def weight_columns(weights):
+    """Restrict interpolation weights to the grid points they use.
+
+    Returns
+    -------
+    cols : np.array
+        Flattened grid indices with a non-zero weight for any station
+    weights : scipy.sparse.csr_matrix
+        (number of buoys, len(cols)) weights over just those points
+    """
+    cols = np.unique(weights.indices)
+    return cols, weights[:, cols]
+
+def station_key(lat, lon):
+    """Sidecar key for a buoy location. Keyed on position rather than station id so
+    that editing a lat/lon pair in configs.py invalidates the extracted series.
+    """
+    return "%.3f_%.3f" % (lat, lon)
+
+def sidecar_name(filename):
+    """Location of the point-extraction sidecar for a grib2 file"""
+    return os.path.splitext(filename)[0] + SIDECAR_EXT
+
+def extract_points(filename, buoys=BUOYS, weights=None):
+    """Decode a WW3 grib2 file and store the time series at every buoy location in a
+    sidecar file. Only the grid points used by the interpolation weights are decoded
+    (see grib.read_grib), so the full wave height and wind speed grids are never held
+    in memory. Every forecast hour of both variables is then interpolated to the stations
+    with a single sparse matrix multiply.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the WW3 grib2 file
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    weights : scipy.sparse.csr_matrix, optional
+        Interpolation weights for each of the buoys, in order. Taken from the weights
+        cache if not provided.
+
+    Returns
+    -------
+    data : dict
+        Per-station model series. See read_points.
+    """
+    log.info(f"Reading: {filename}")
+    stn_ids = list(buoys.keys())
+    messages = grib.inventory(filename)
+    if weights is None:
+        lat, lon = grib.read_grid(filename)
+        weights = interp_weights(lon - 360., lat, grib_water_mask(filename, messages),
+                                 buoys)
+    cols, weights = weight_columns(weights)
+
+    # Every needed point at once as (time, point)
+    ds = grib.read_grib(filename, ['swh', 'ws'], indices=cols, messages=messages)
+    values = np.hstack((ds['swh'].T * M2FT, ds['ws'].T * MS2KT))
+    wvhgt, wspd = np.hsplit((weights @ values).astype(np.float32), 2)
+    time, runtime = ds['time'], ds['runtime']
+    keys = np.array([station_key(*buoys[stn_id][0:2]) for stn_id in stn_ids])
+
+    # Write to a temporary file and rename so readers never see a partial sidecar
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, keys=keys, wvhgt=wvhgt, wspd=wspd, time=time, runtime=runtime,
+                 version=SIDECAR_VERSION)
+    os.replace(tmp, sidecar_name(filename))
+    log.info(f"Extracted {len(stn_ids)} stations from: {filename}")
+
+    return {
+        'wvhgt': dict(zip(stn_ids, wvhgt)),
+        'wspd': dict(zip(stn_ids, wspd)),
+        'time': pd.to_datetime(time),
+        'runtime': pd.to_datetime(runtime)
+    }
+
+def read_points(filename, buoys=BUOYS):
+    """Read the point-extraction sidecar for a grib2 file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the WW3 grib2 file (not the sidecar)
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+
+    Returns
+    -------
+    data : dict or None
+        Dictionary with 'wvhgt' and 'wspd' mapping each station id to its model series,
+        and the 'time' and 'runtime' of the cycle. None if the sidecar is missing,
+        older than the grib2 file, from an older SIDECAR_VERSION, or lacks any of the
+        requested buoy locations.
+    """
+    sidecar = sidecar_name(filename)
+    try:
+        if os.path.getmtime(sidecar) < os.path.getmtime(filename):
+            return None
+        with np.load(sidecar, allow_pickle=False) as npz:
+            if int(npz['version']) != SIDECAR_VERSION:
+                return None
+            keys = {key: n for n, key in enumerate(npz['keys'])}
+            rows = [keys[station_key(*buoys[stn_id][0:2])] for stn_id in buoys]
+            data = {
+                'wvhgt': dict(zip(buoys.keys(), npz['wvhgt'][rows])),
+                'wspd': dict(zip(buoys.keys(), npz['wspd'][rows])),
+                'time': pd.to_datetime(npz['time']),
+                'runtime': pd.to_datetime(npz['runtime'])
+            }
+    except (OSError, KeyError, ValueError):
+        return None
+    return data
+
+def cached_points(filename, buoys=BUOYS, fhr=None):
+    """Return buoy-point series previously loaded by this process, or None if they
+    aren't cached or the grib2 file has since changed.
+    """
+    try:
+        mtime, data = _points[(filename, fhr)]
+        if mtime == os.path.getmtime(filename) and all(stn_id in data['wvhgt']
+                                                       for stn_id in buoys):
+            return data
+    except (KeyError, OSError):
+        pass
+    return None
+
+def cache_points(filename, data, fhr=None):
+    """Keep buoy-point series in memory for later calls to load_points"""
+    try:
+        _points[(filename, fhr)] = (os.path.getmtime(filename), data)
+    except OSError:
+        pass
+
+def prune_points(filenames):
+    """Drop cached buoy-point series for any files not in filenames"""
+    keep = set(filenames)
+    for key in [key for key in _points if key[0] not in keep]:
+        del _points[key]
+
+def load_points(filename, buoys=BUOYS, fhr=None):
+    """Return the buoy-point model series for a grib2 file, only falling back to
+    decoding the grib2 file when the sidecar is missing or stale.
+
+    This is safe to map across a multiprocessing.Pool: any decoding happens within the
+    worker, and only the per-station series (trimmed to the first fhr forecast hours)
+    are pickled back to the parent process.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the WW3 grib2 file
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    fhr : int, optional
+        Number of forecast hours to return. Default is the full cycle.
+    """
+    data = cached_points(filename, buoys, fhr)
+    if data is not None:
+        return data
+
+    data = read_points(filename, buoys)
+    if data is None:
+        data = extract_points(filename, buoys)
+
+    data = trim_points(data, fhr)
+    cache_points(filename, data, fhr)
+    return data
+
+def trim_points(data, fhr=None):
+    """Trim buoy-point series to the first fhr forecast hours"""
+    if fhr is not None:
+        data['time'] = data['time'][0:fhr]
+        for var in ['wvhgt', 'wspd']:
+            data[var] = {stn_id: series[0:fhr] for stn_id, series in data[var].items()}
+    return data
+
+def decode_points(filename, buoys=BUOYS, fhr=None):
+    """Decode a grib2 file in a worker process for stream_points. Unlike load_points
+    nothing is cached, so the worker's memory doesn't grow with the number of files.
+
+    Returns
+    -------
+    data : dict
+        Per-station model series. See read_points.
+    rss : float
+        Peak resident set size of the worker, in MB
+    """
+    data = trim_points(extract_points(filename, buoys), fhr)
+    return data, telemetry.peak_rss_mb()
+
+def stream_points(filenames, buoys=BUOYS, fhr=None, pool=None, window=STREAM_WINDOW,
+                  memory_limit=MEMORY_LIMIT):
+    """Yield the buoy-point series of each file in order, without holding more than a
+    window of them at once. Current sidecars are read in this process. Other files are
+    decoded by the pool, at most window at a time, and the window shrinks if the peak
+    memory reported by the workers means window decodes would exceed memory_limit. As
+    nothing is cached, memory use doesn't depend on the number of files.
+
+    Parameters
+    ----------
+    filenames : iterable
+        WW3 grib2 files, in the order to yield them
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    fhr : int, optional
+        Number of forecast hours to return. Default is the full cycle.
+    pool : multiprocessing.Pool, optional
+        Pool to decode grib2 files with. Serial if not provided.
+    window : int
+        Maximum number of files in flight
+    memory_limit : float
+        Combined memory ceiling (MB) of the decoding workers
+
+    Yields
+    ------
+    filename : str
+    data : dict
+        Per-station model series. See read_points.
+    """
+    filenames = iter(filenames)
+    pending = deque()
+    while True:
+        while len(pending) < window:
+            filename = next(filenames, None)
+            if filename is None:
+                break
+            data = read_points(filename, buoys)
+            if data is not None:
+                pending.append((filename, trim_points(data, fhr), None))
+            elif pool is not None:
+                result = pool.apply_async(decode_points, (filename, buoys, fhr))
+                pending.append((filename, None, result))
+            else:
+                pending.append((filename, None, None))
+        if not pending:
+            return
+
+        filename, data, result = pending.popleft()
+        if data is None:
+            if result is None:
+                data, rss = decode_points(filename, buoys, fhr)
+            else:
+                data, rss = result.get()
+            if rss * window > memory_limit and window > 1:
+                window = max(1, int(memory_limit // rss))
+                log.info(f"Decoding {window} files at a time ({rss:.0f} MB each)")
+        yield filename, data
+
+def find_files(start, end):
+    """Glob the WW3 grib2 files within DATA_DIR between two dates"""
+    files = []
+    while start <= end:
+        date_string = datetime.strftime(start, "%Y-%m-%d")
+        files.extend(sorted(glob("%s/%s/*.grib2" % (DATA_DIR, date_string))))
+        start += timedelta(days=1)
+    return files
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-f', '--files', dest="files", nargs="+",
+                    help="grib2 files to extract. Default: the last NUM_DAYS of data")
+    args = ap.parse_args()
+
+    if args.files:
+        files = args.files
+    else:
+        NOW = datetime.now()
+        files = find_files(NOW - timedelta(days=NUM_DAYS), NOW)
+
+    for f in files:
+        if read_points(f) is None:
+            extract_points(f)
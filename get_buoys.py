@@ -1,23 +1,138 @@
-from subprocess import Popen, PIPE
-try:
-    from shutil import which
-except ImportError:
-    from distutils.spawn import find_executable as which
-from configs import BUOYS, BUOY_URL, DATA_DIR
-from cron_helper import timestamp
-
-# Logic to find wget or curl on the system
-WGET = which('wget')
-if not WGET:
-    CURL = which('curl')
-if not WGET and not CURL:
-    raise ValueError("Neither wget nor curl found on the system. Exiting")
-
-for buoy in BUOYS.keys():
-    url = "%s/%s.txt" % (BUOY_URL, buoy)
-    if WGET:
-        p = Popen([WGET, '-O', '%s/%s.txt' % (DATA_DIR, buoy), url], stderr=PIPE)
-    elif CURL:
-        p = Popen([CURL, '-o','%s/%s.txt' % (DATA_DIR, buoy), url], stderr=PIPE)
-    p.wait()
-    timestamp("INFO", url)
+"""
+Download realtime NDBC observations for each of the BUOYS. Stations are fetched
+concurrently over a shared keep-alive session. Requests are conditional on the ETag and
+Last-Modified headers from the previous download, so an unchanged file costs a single
+304 response and is not rewritten.
+
+    python get_buoys.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import json
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from configs import BUOYS, BUOY_URL, DATA_DIR, BUOY_THREADS
+from cron_helper import logfile
+log = logfile("buoys.log")
+import telemetry
+
+# ETag and Last-Modified headers from the last download of each station
+STATE_FILE = f"{DATA_DIR}/buoys.json"
+
+def make_session(nthreads=BUOY_THREADS):
+    """requests.Session with a keep-alive connection pool shared by nthreads workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=nthreads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_buoy(session, url, fname, validators):
+    """Conditionally download a single NDBC text file.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session to issue the request with
+    url : str
+        URL of the realtime2 text file
+    fname : str
+        Output location on the local file system
+    validators : dict
+        'etag' and 'last_modified' from the previous download. May be empty.
+
+    Returns
+    -------
+    changed : bool
+        True if a new file was written
+    validators : dict
+        Validators to send with the next request
+    """
+
+    headers = {}
+    if os.path.exists(fname):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    r = session.get(url, headers=headers, timeout=30)
+    if r.status_code == 304:
+        telemetry.count('files_skipped', stage='get_buoys')
+        return False, validators
+    r.raise_for_status()
+    telemetry.count('bytes_downloaded', len(r.content), source='ndbc')
+
+    # Write to a temporary file and rename so readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or ".", suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(r.content)
+    os.replace(tmp, fname)
+    return True, {'etag': r.headers.get('ETag'),
+                  'last_modified': r.headers.get('Last-Modified')}
+
+@telemetry.stage('get_buoys')
+def get_buoys(buoys=BUOYS, data_dir=DATA_DIR, base_url=BUOY_URL, state_file=None,
+              nthreads=BUOY_THREADS, session=None):
+    """Download the realtime2 text files for each station, with at most nthreads
+    requests in flight.
+
+    Parameters
+    ----------
+    buoys : dict
+        Buoy metadata in the form of configs.BUOYS
+    data_dir : str
+        Directory to store the text files in
+    base_url : str
+        NDBC realtime2 directory
+    state_file : str, optional
+        Location of the stored ETag/Last-Modified headers. Default: STATE_FILE
+    nthreads : int
+        Number of concurrent downloads
+    session : requests.Session, optional
+        Session to reuse. A new one is created if not provided.
+
+    Returns
+    -------
+    changed : list
+        Station ids whose files were updated
+    """
+
+    state_file = state_file or STATE_FILE
+    session = session or make_session(nthreads)
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+
+    def fetch(stn_id):
+        url = "%s/%s.txt" % (base_url.rstrip('/'), stn_id)
+        fname = "%s/%s.txt" % (data_dir, stn_id)
+        try:
+            changed, validators = fetch_buoy(session, url, fname, state.get(stn_id, {}))
+        except requests.RequestException as e:
+            log.error("%s : %s" % (url, e))
+            return stn_id, False, state.get(stn_id, {})
+        log.info("%s : %s" % (url, "updated" if changed else "not modified"))
+        return stn_id, changed, validators
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        results = list(executor.map(fetch, buoys.keys()))
+
+    changed = []
+    for stn_id, updated, validators in results:
+        state[stn_id] = validators
+        if updated: changed.append(stn_id)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(state_file) or ".", suffix=".tmp")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_file)
+    return changed
+
+if __name__ == '__main__':
+    telemetry.init('get_buoys')
+    get_buoys()
+    telemetry.flush()
@@ -1,37 +1,86 @@
 """
-Run at 7:30 and 19:30 UTC to grab full WW3 runs
+Download GLWU WW3 cycles from NOMADS. Either a single cycle, polled for until it
+appears (run at 7:30 and 19:30 UTC to grab full WW3 runs), or a backfill of every
+cycle within the NOMADS retention window that's missing under DATA_DIR.
+
+    python get_ww3.py -t 2020-10-11/07
+    python get_ww3.py -b
 """
 import time
-from datetime import datetime
-import os, sys, errno
-from subprocess import Popen, PIPE
-import subprocess
-try:
-    from urllib.request import urlopen, URLError        # Python 3
-except ImportError:
-    from urllib2 import urlopen, URLError               # Python 2
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import os, sys, re, json, random, threading
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-from cron_helper import logfile
+import requests
+from requests.adapters import HTTPAdapter
+from cron_helper import logfile, locked
 log = logfile(f"ww3.log")
+import telemetry
 from configs import GRIB_VARS, DATA_DIR, REALTIME_URL, SLEEP_TIME, TIME_LIMIT
+from configs import DOWNLOAD_THREADS, CYCLE_HOURS, RETENTION_DAYS, MAX_CONNECTIONS
+from configs import MAX_REQUESTS, MAX_CYCLES
+
+# Size of the blocks streamed from each range request to the output file
+CHUNK_SIZE = 1024 * 1024
+
+# First delay (seconds) between polls for a cycle. Doubles up to SLEEP_TIME.
+POLL_MIN = 15
 
 SCRIPT_PATH = os.path.dirname(__file__) or "."
-def timeout_check():
-    """Determine how long this process has been running. Kill it if over TIME_LIMIT
+def timeout_check(then):
+    """Determine how long a download has been running. Returns True if over TIME_LIMIT
     """
     NOW = time.time()
-    if NOW - THEN > TIME_LIMIT * 3600:
+    if NOW - then > TIME_LIMIT * 3600:
         log.error("Exceeded time limit")
-        sys.exit(1)
+        return True
+    return False
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of requests shared across threads"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = burst or max(1., self.rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-def is_url_alive(url):
-    """Test for file existence on the NOMADS server by looking for the corresponding
-    .idx file
+class LimitedSession(requests.Session):
+    """requests.Session that takes a token from a RateLimiter before every request"""
+    def __init__(self, limiter=None):
+        super(LimitedSession, self).__init__()
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        return super(LimitedSession, self).request(*args, **kwargs)
+
+def is_url_alive(url, session=None):
+    """Test for file existence on the NOMADS server with a HEAD request for the
+    corresponding .idx file. NOMADS writes the inventory once the GRIB2 file is
+    complete, and nothing but the headers is transferred.
 
     Parameters
     ----------
     url : str
-        URL to test for existence on the NOMADS server
+        URL of the GRIB2 file to test for existence on the NOMADS server
+    session : requests.Session, optional
+        Session to issue the request with
 
     Returns
     -------
@@ -39,40 +88,390 @@ def is_url_alive(url):
     """
 
     try:
-        urlopen(url, timeout=10)
-        return True
-    except URLError:
-        return False
-    except socket.timeout:
-        return False
-    except socket.error:
+        r = (session or requests).head(url + '.idx', timeout=10, allow_redirects=True)
+    except requests.RequestException:
         return False
+    return r.status_code == 200
+
+def parse_idx(text, pattern=GRIB_VARS):
+    """Parse a .idx inventory and return the byte ranges of the GRIB records matching
+    pattern. This is the equivalent of get_inv.pl | egrep pattern.
+
+    Parameters
+    ----------
+    text : str
+        Contents of the .idx file. Each line is of the form:
+        1:0:d=2020101106:HTSGW:surface:anl:
+    pattern : str
+        Regular expression used to select the records. Default: GRIB_VARS
+
+    Returns
+    -------
+    ranges : list
+        (start, end) byte ranges, inclusive. The end of the final record in the file
+        is unknown, and is returned as None.
+    """
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    offsets = [int(line.split(':')[1]) for line in lines]
+    ranges = []
+    for n, line in enumerate(lines):
+        if not re.search(pattern, line):
+            continue
+        # Sub-messages share the byte offset of their parent message
+        end = None
+        for offset in offsets[n+1:]:
+            if offset > offsets[n]:
+                end = offset - 1
+                break
+        ranges.append((offsets[n], end))
+    return ranges
+
+def merge_ranges(ranges):
+    """Merge adjacent or overlapping byte ranges so contiguous records are fetched with
+    a single request.
+
+    Parameters
+    ----------
+    ranges : list
+        (start, end) byte ranges, inclusive. An end of None extends to the end of file.
 
-def get_filesize(fname):
-    """Test filesize on the local system. If the file DNE, return a filsize of 0 bytes.
+    Returns
+    -------
+    merged : list
+        Sorted and merged (start, end) byte ranges
+    """
+
+    merged = []
+    for start, end in sorted(set(ranges), key=lambda r: r[0]):
+        if merged and merged[-1][1] is not None and start <= merged[-1][1] + 1:
+            last_end = merged[-1][1]
+            merged[-1] = (merged[-1][0], None if end is None else max(end, last_end))
+        elif merged and merged[-1][1] is None:
+            continue
+        else:
+            merged.append((start, end))
+    return merged
+
+def make_session(nthreads=DOWNLOAD_THREADS, rate=MAX_REQUESTS):
+    """requests.Session with a keep-alive connection pool of nthreads connections.
+    Requests block while every connection is in use, so nthreads is also the limit on
+    concurrent connections to the server, and at most rate requests are issued per
+    second.
+    """
+    session = LimitedSession(RateLimiter(rate) if rate else None)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=nthreads, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_range(session, url, start, end, fd, out_offset):
+    """Download a single byte range and write it to the open file descriptor fd
+    starting at out_offset.
+
+    Returns
+    -------
+    nbytes : int
+        Number of bytes written
+    """
+
+    header = "bytes=%d-%s" % (start, '' if end is None else end)
+    pos = out_offset
+    with session.get(url, headers={'Range': header}, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError("Server ignored range request for %s" % (url))
+        for chunk in r.iter_content(CHUNK_SIZE):
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+
+    nbytes = pos - out_offset
+    if end is not None and nbytes != end - start + 1:
+        raise IOError("Expected %d bytes from %s, got %d" % (end-start+1, url, nbytes))
+    return nbytes
+
+def grib_length(header):
+    """Total message length from the indicator section (section 0) of a GRIB message.
+    Returns None if header is not the start of a GRIB message.
+    """
+    if len(header) < 16 or header[:4] != b'GRIB':
+        return None
+    if header[7] == 2:
+        return int.from_bytes(header[8:16], 'big')
+    elif header[7] == 1:
+        return int.from_bytes(header[4:7], 'big')
+    return None
+
+def check_records(fname, records, offsets):
+    """Validate each GRIB record within a (partially) downloaded file. A record is
+    valid if it starts with the GRIB indicator, its length matches both the section 0
+    message length and the .idx byte range, and it ends with the 7777 trailer.
 
     Parameters
     ----------
     fname : str
-        Location on the local file system to grab filesize for
+        Local file to check
+    records : list
+        (start, end) byte ranges of each record on the server
+    offsets : list
+        Position of each record within fname
 
     Returns
     -------
-    fsize : int
-        Filsize (bytes)
+    bad : list
+        Indices of records that are missing or corrupt
+    size : int or None
+        Expected size of the complete file, or None if the final record is missing
     """
 
     try:
-        fsize = os.stat(fname).st_size
-    except:
-        fsize = 0
-    return fsize
+        fd = os.open(fname, os.O_RDONLY)
+    except OSError:
+        return list(range(len(records))), None
+
+    bad = []
+    size = None
+    try:
+        for n, ((start, end), offset) in enumerate(zip(records, offsets)):
+            length = grib_length(os.pread(fd, 16, offset))
+            if length is None or (end is not None and length != end - start + 1):
+                bad.append(n)
+                continue
+            message = os.pread(fd, length, offset)
+            if len(message) != length or message[-4:] != b'7777':
+                bad.append(n)
+            elif n == len(records) - 1:
+                size = offset + length
+    finally:
+        os.close(fd)
+    return bad, size
 
-def get_ww3(run_time):
-    """Download realtime WW3 data from the NCEP NOMADS server. This function uses
-    Wesley Ebisuzaki's get_inv.pl and get_grib.pl scripts to allow downloading of a
-    small subset of the full grib2 data files. Saves a ton of space and time!
-    Further information can be found at [1]_ below.
+def download_subset(url, fname, pattern=GRIB_VARS, session=None,
+                    nthreads=DOWNLOAD_THREADS):
+    """Download the GRIB records matching pattern from url into fname. The .idx
+    inventory is parsed in-process, adjacent records are merged into single byte
+    ranges, and the ranges are fetched in parallel over a shared keep-alive session.
+    Each range is written directly to its position in the output file.
+
+    Data are written to fname.part, with the record layout stored alongside in
+    fname.part.json. On a repeat call, only records that are missing or fail GRIB
+    validation are fetched again. fname only appears, via an atomic rename, once
+    every record is valid.
+
+    Parameters
+    ----------
+    url : str
+        URL of the full GRIB2 file on the server. The inventory is expected at url.idx
+    fname : str
+        Output location on the local file system
+    pattern : str
+        Regular expression used to select records from the inventory
+    session : requests.Session, optional
+        Session to reuse. A new one is created if not provided.
+    nthreads : int
+        Number of concurrent range requests
+
+    Returns
+    -------
+    nbytes : int
+        Number of bytes downloaded
+    """
+
+    session = session or make_session(nthreads)
+    r = session.get(url + '.idx', timeout=30)
+    r.raise_for_status()
+    records = sorted(set(parse_idx(r.text, pattern)))
+    if not records:
+        raise ValueError("No records matching %s in %s.idx" % (pattern, url))
+
+    # Position of each record within the output file
+    offsets = [0]
+    for start, end in records[:-1]:
+        offsets.append(offsets[-1] + end - start + 1)
+
+    # Discard any partial download that was made against a different inventory
+    tmp = fname + '.part'
+    state_file = tmp + '.json'
+    state = json.loads(json.dumps({'url': url, 'records': records}))
+    try:
+        with open(state_file) as f:
+            resumable = json.load(f) == state
+    except (OSError, ValueError):
+        resumable = False
+    if not resumable:
+        if os.path.exists(tmp): os.remove(tmp)
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+
+    bad, size = check_records(tmp, records, offsets)
+    if bad:
+        log.info("Fetching %d of %d records for %s" % (len(bad), len(records), fname))
+    position = dict((start, offset) for (start, end), offset in zip(records, offsets))
+    ranges = merge_ranges([records[n] for n in bad])
+
+    nbytes = 0
+    if ranges:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                jobs = [executor.submit(fetch_range, session, url, start, end, fd,
+                                        position[start]) for start, end in ranges]
+                nbytes = sum(job.result() for job in jobs)
+        finally:
+            os.close(fd)
+        bad, size = check_records(tmp, records, offsets)
+
+    telemetry.count('bytes_downloaded', nbytes, source='nomads')
+    if bad:
+        raise IOError("%d of %d records in %s failed validation" % (len(bad),
+                      len(records), tmp))
+    telemetry.count('grib_records', len(records))
+    os.truncate(tmp, size)
+    os.replace(tmp, fname)
+    os.remove(state_file)
+    return nbytes
+
+def try_download(url, fname, session=None, nthreads=DOWNLOAD_THREADS):
+    """Run download_subset, logging any failure. Partially downloaded data are kept so
+    the next attempt only fetches the missing or corrupt records.
+
+    Returns
+    -------
+    __ : bool
+        True if the download completed
+    """
+
+    try:
+        nbytes = download_subset(url, fname, session=session, nthreads=nthreads)
+    except (requests.RequestException, IOError, ValueError) as e:
+        log.error("Download of %s failed: %s" % (url, e))
+        telemetry.count('retries', stage='get_ww3')
+        return False
+    log.info("Downloaded %d bytes to %s" % (nbytes, fname))
+    return True
+
+@contextmanager
+def download_lock(fname):
+    """Non-blocking lock on a cycle, so run.py's scheduled download, a backfill and a
+    command-line run never write the same .part file at once. Yields False if another
+    download holds the lock.
+    """
+    lock_file = fname + '.lock'
+    with locked(lock_file, blocking=False) as acquired:
+        try:
+            yield acquired
+        finally:
+            if acquired and os.path.exists(fname): os.remove(lock_file)
+
+def cycle_file(dt, base_url=REALTIME_URL, data_dir=DATA_DIR):
+    """URL of a cycle on NOMADS, and its location under data_dir"""
+    fname = 'glwu.grlc_2p5km.t%02dz.grib2' % (dt.hour)
+    url = '%s%s/%s' % (base_url, dt.strftime('%Y%m%d'), fname)
+    return url, "%s/%s/%s" % (data_dir, dt.strftime('%Y-%m-%d'), fname)
+
+def acquire_cycle(dt, session, wait=False, base_url=REALTIME_URL, data_dir=DATA_DIR,
+                  nthreads=DOWNLOAD_THREADS):
+    """Download a single cycle once its .idx inventory is on the server.
+
+    Parameters
+    ----------
+    dt : datetime
+        Cycle time
+    session : requests.Session
+        Session to issue every request with
+    wait : bool
+        Keep polling for the cycle, with exponential backoff from POLL_MIN to
+        SLEEP_TIME seconds, until it's downloaded or TIME_LIMIT hours have passed.
+        Otherwise a single attempt is made.
+    base_url : str
+        NOMADS GLWU directory. Default: REALTIME_URL
+    data_dir : str
+        Local data directory. Default: DATA_DIR
+
+    Returns
+    -------
+    full_name : str or None
+        Location of the downloaded .grib2 file, or None if it couldn't be downloaded
+    """
+
+    url, full_name = cycle_file(dt, base_url, data_dir)
+    if os.path.exists(full_name):
+        return full_name
+    run_time = dt.strftime('%Y-%m-%d/%H')
+
+    # Poll for the file on the server. Failed downloads are retried, resuming from
+    # whichever records were already validated.
+    then = time.time()
+    delay = POLL_MIN
+    while True:
+        if is_url_alive(url, session):
+            telemetry.cycle_seen(run_time)
+            os.makedirs(os.path.dirname(full_name), exist_ok=True)
+            with download_lock(full_name) as locked:
+                if not locked:
+                    log.info("%s is already being downloaded" % (full_name))
+                    return None
+                log.info("Downloading %s" % (full_name))
+                if os.path.exists(full_name) or try_download(url, full_name, session,
+                                                             nthreads):
+                    telemetry.cycle_downloaded(run_time)
+                    return full_name
+        elif wait:
+            log.info("Can't find %s. Sleeping %d s." % (url, delay))
+        else:
+            log.info("Can't find %s" % (url))
+
+        if not wait or timeout_check(then):
+            return None
+        time.sleep(delay * random.uniform(0.9, 1.1))
+        delay = min(delay * 2, SLEEP_TIME)
+
+def missing_cycles(now=None, days=RETENTION_DAYS, hours=CYCLE_HOURS, data_dir=DATA_DIR):
+    """Cycles within the last days days (the NOMADS retention window) that aren't
+    under data_dir, oldest first.
+    """
+    now = now or datetime.utcnow()
+    start = now - timedelta(days=days)
+    day = datetime(start.year, start.month, start.day)
+    cycles = []
+    while day <= now:
+        for hour in hours:
+            dt = day + timedelta(hours=hour)
+            fname = cycle_file(dt, data_dir=data_dir)[1]
+            if start <= dt <= now and not os.path.exists(fname):
+                cycles.append(dt)
+        day += timedelta(days=1)
+    return cycles
+
+@telemetry.stage('backfill')
+def backfill(now=None, session=None, max_cycles=MAX_CYCLES, base_url=REALTIME_URL,
+             data_dir=DATA_DIR):
+    """Download every missing cycle within the NOMADS retention window. Up to
+    max_cycles cycles are downloaded at once, sharing one session, so every request
+    counts against the same connection and rate limits.
+
+    Returns
+    -------
+    files : list
+        Cycles that were downloaded
+    """
+
+    cycles = missing_cycles(now, data_dir=data_dir)
+    if not cycles:
+        return []
+    log.info("Backfilling %d missing cycles" % (len(cycles)))
+    session = session or make_session(MAX_CONNECTIONS)
+    acquire = lambda dt: acquire_cycle(dt, session, False, base_url, data_dir)
+    with ThreadPoolExecutor(max_workers=max_cycles) as executor:
+        results = list(executor.map(acquire, cycles))
+    return [f for f in results if f is not None]
+
+@telemetry.stage('get_ww3')
+def get_ww3(run_time, session=None):
+    """Download realtime WW3 data from the NCEP NOMADS server. Only the GRIB_VARS
+    records are downloaded, using HTTP range requests driven by the .idx inventory
+    (the approach of Wesley Ebisuzaki's get_inv.pl and get_grib.pl scripts). Saves a
+    ton of space and time! Further information can be found at [1]_ below.
 
     [1]_: Ebisuzaki, W.: Fast Downloading of GRIB Files: Partial http transfers.
               https://www.cpc.ncep.noaa.gov/products/wesley/fast_downloading_grib.html
@@ -81,73 +480,45 @@ def get_ww3(run_time):
     ----------
     run_time : string
         Time of the model run to be downloaded. For is: YYYY-MM-DD/HH
+    session : requests.Session, optional
+        Session to reuse. A new one is created if not provided.
 
     Returns
     -------
-    Individual .grib2 files downloaded to the local system.
+    full_name : str or None
+        Location of the downloaded .grib2 file on the local system. None if the file
+        couldn't be downloaded within TIME_LIMIT.
     """
 
     dt = datetime.strptime(run_time, '%Y-%m-%d/%H')
-    data_path = "%s/%s" % (DATA_DIR, dt.strftime('%Y-%m-%d'))
+    return acquire_cycle(dt, session or make_session(MAX_CONNECTIONS), wait=True)
 
-    # Not too pretty, but watch for a potential RACE conditions on multiple crons?
-    try:
-        os.makedirs(data_path)
-    except OSError as e:
-        if e.errno != errno.EEXIST: raise
-
-    date_str = dt.strftime('%Y%m%d%H')
-    fname = 'glwu.grlc_2p5km.t%sz.grib2' % (date_str[-2:])
-    url = '%s%s/%s' % (REALTIME_URL, date_str[0:8], fname)
-    full_name = data_path + '/' + fname
-
-    # Shell argument string to invoke the get_grib.pl script.
-    arg = '%s/etc/get_inv.pl %s.idx | egrep "%s" | %s/etc/get_grib.pl %s %s' \
-           % (SCRIPT_PATH, url, GRIB_VARS, SCRIPT_PATH, url, full_name)
-
-    # Test for file existence.
-    num_attempts = 1
-    file_exists = False
-    while not file_exists and num_attempts < 90 and not os.path.exists(full_name):
-        file_exists = is_url_alive(url)
-
-        if file_exists:
-            # As long as we trust the input argument here. Don't extend this to take a
-            # command-line argument, however.
-            subprocess.call(arg, shell=True)
-            log.info("Downloading %s" % (full_name))
-            break
-        else:
-            log.info("Can't find %s. Sleeping." % (url))
-
-        num_attempts += 1
-        time.sleep(SLEEP_TIME)
-        timeout_check()
-
-    # Test for file size on the local system.
-    num_attempts = 1
-    file_size = get_filesize(full_name)
-    while file_size < 10 and num_attempts < 10:
-        file_size = get_filesize(full_name)
-        log.warning("File not of expected size. Re-downloading")
-        subprocess.call(arg, shell=True)
-        num_attempts += 1
-        time.sleep(SLEEP_TIME)
-        timeout_check()
-
-ap = argparse.ArgumentParser()
-ap.add_argument('-t', '--time-str', dest="time_str", help="YYYY-MM-DD/HH")
-args = ap.parse_args()
-
-if not args.time_str:
-    # No arguments passed. Cycle time will be the current hour.
-    NOW = datetime.utcnow()
-    time_str = NOW.strftime('%Y-%m-%d/%H')
-else:
-    # User-specified cycle time
-    time_str = args.time_str
-
-THEN = time.time()
-log.info("Starting WW3 Download for %s" % (time_str))
-get_ww3(time_str)
-log.info("Download Complete")
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-t', '--time-str', dest="time_str", help="YYYY-MM-DD/HH")
+    ap.add_argument('-b', '--backfill', dest="backfill", action='store_true',
+                    help="Download every missing cycle still on NOMADS")
+    args = ap.parse_args()
+
+    if args.backfill:
+        telemetry.init('backfill')
+        files = backfill()
+        log.info("Backfilled %d cycles" % (len(files)))
+        telemetry.flush()
+        sys.exit(0 if not missing_cycles() else 1)
+
+    if not args.time_str:
+        # No arguments passed. Cycle time will be the current hour.
+        NOW = datetime.utcnow()
+        time_str = NOW.strftime('%Y-%m-%d/%H')
+    else:
+        # User-specified cycle time
+        time_str = args.time_str
+
+    telemetry.init('get_ww3')
+    log.info("Starting WW3 Download for %s" % (time_str))
+    fname = get_ww3(time_str)
+    telemetry.flush()
+    if fname is None:
+        sys.exit(1)
+    log.info("Download Complete")
@@ -0,0 +1,137 @@
+"""
+Lean GRIB2 reader for the WW3 cycles. Messages are walked with eccodes, reading only
+their headers, and only the messages of the requested variables and first forecast
+hours are decoded. Values go straight into preallocated float32 arrays, either over the
+full grid or at a list of grid indices. Unlike the cfgrib engine, no .idx file is
+written and no xarray Dataset is built.
+
+    import grib
+    data = grib.read_grib(filename, ['swh', 'ws'], fhr=84)
+"""
+import numpy as np
+import eccodes
+
+# GRIB2 (discipline, parameterCategory, parameterNumber) of each variable, by its
+# eccodes shortName. Matching on these is much cheaper than looking up shortName.
+PARAMS = {
+    'swh': (10, 0, 3),
+    'ws': (0, 2, 1),
+    'wdir': (0, 2, 0),
+}
+
+def inventory(filename):
+    """Read the header of every message in a GRIB2 file, without decoding any values.
+
+    Returns
+    -------
+    messages : list
+        (offset, param, step, runtime) of each message. param is the (discipline,
+        parameterCategory, parameterNumber) of the message, step is in hours and
+        runtime is a datetime64[s].
+    """
+    messages = []
+    with open(filename, 'rb') as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if gid is None:
+                break
+            try:
+                date = str(eccodes.codes_get(gid, 'dataDate'))
+                hhmm = eccodes.codes_get(gid, 'dataTime')
+                runtime = np.datetime64("%s-%s-%s" % (date[0:4], date[4:6], date[6:8]),
+                                        's') + np.timedelta64(hhmm // 100 * 60 +
+                                                              hhmm % 100, 'm')
+                param = tuple(eccodes.codes_get(gid, key) for key in
+                              ['discipline', 'parameterCategory', 'parameterNumber'])
+                messages.append((eccodes.codes_get_message_offset(gid), param,
+                                 eccodes.codes_get(gid, 'endStep', int), runtime))
+            finally:
+                eccodes.codes_release(gid)
+    return messages
+
+def decode(gid, out, indices=None):
+    """Decode the values of a message into out, as NaN where they're missing"""
+    if indices is None:
+        out[:] = eccodes.codes_get_float_array(gid, 'values')
+    else:
+        out[:] = eccodes.codes_get_double_elements(gid, 'values', indices)
+    if eccodes.codes_get(gid, 'bitmapPresent'):
+        out[out == eccodes.codes_get(gid, 'missingValue')] = np.nan
+
+def read_grid(filename):
+    """Latitudes and longitudes (0-360) of the grid of the first message in a file
+
+    Returns
+    -------
+    lat, lon : np.array
+        2-d arrays of gridded latitudes and longitudes
+    """
+    with open(filename, 'rb') as f:
+        gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+        try:
+            shape = (eccodes.codes_get(gid, 'Ny'), eccodes.codes_get(gid, 'Nx'))
+            lat = eccodes.codes_get_array(gid, 'latitudes').reshape(shape)
+            lon = eccodes.codes_get_array(gid, 'longitudes').reshape(shape)
+        finally:
+            eccodes.codes_release(gid)
+    return lat, lon
+
+def read_grib(filename, variables, fhr=None, indices=None, messages=None, first=0):
+    """Decode the requested variables over the first fhr forecast steps of a file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the GRIB2 file
+    variables : list
+        eccodes shortNames of the variables to decode. Any of PARAMS.
+    fhr : int, optional
+        Number of forecast steps to decode. Default is every step.
+    indices : np.array, optional
+        Flattened grid indices to decode values at. Default is the full grid.
+    messages : list, optional
+        The file's inventory, if already read
+    first : int
+        Skip the steps before this one, so a range of steps can be decoded
+
+    Returns
+    -------
+    data : dict
+        float32 (step, y, x) arrays, or (step, index) arrays if indices are given, for
+        each variable, with steps missing from the file as NaN. Also the forecast
+        'time' (datetime64[ns]) of each step and the 'runtime' of the cycle.
+    """
+    names = dict((PARAMS[var], var) for var in variables)
+    messages = [m for m in messages or inventory(filename) if m[1] in names]
+    if not messages:
+        raise ValueError("None of %s found in %s" % (", ".join(variables), filename))
+    steps = sorted(set(m[2] for m in messages))[first:fhr]
+    row = dict((step, n) for n, step in enumerate(steps))
+    runtime = messages[0][3]
+
+    if indices is None:
+        with open(filename, 'rb') as f:
+            gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            shape = (eccodes.codes_get(gid, 'Ny'), eccodes.codes_get(gid, 'Nx'))
+            eccodes.codes_release(gid)
+    else:
+        indices = [int(i) for i in indices]
+        shape = (len(indices),)
+
+    data = dict((var, np.full((len(steps),) + shape, np.nan, dtype=np.float32))
+                for var in variables)
+    with open(filename, 'rb') as f:
+        for offset, param, step, _ in messages:
+            if step not in row:
+                continue
+            f.seek(offset)
+            gid = eccodes.codes_grib_new_from_file(f)
+            try:
+                decode(gid, data[names[param]][row[step]].reshape(-1), indices)
+            finally:
+                eccodes.codes_release(gid)
+
+    data['time'] = (runtime + np.array(steps, dtype='timedelta64[h]')).astype(
+        'datetime64[ns]')
+    data['runtime'] = runtime.astype('datetime64[ns]')
+    return data
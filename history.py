@@ -0,0 +1,173 @@
+"""
+Bulk ingestion of NDBC historical standard meteorological (stdmet) archives, for
+verification over periods older than the 45 days of realtime2 data. Yearly
+(45007h2019.txt.gz) and monthly (4500712020.txt.gz) files are parsed in parallel and
+merged into the same per-station stores as the realtime observations (see ndbc.py).
+Where historical and realtime observations overlap, the quality-controlled historical
+values are kept.
+
+To download and ingest the yearly files of each of the BUOYS:
+    python history.py -y 2018 2019 2020 -np 8
+
+For local files:
+    python history.py -f data/history/*.txt.gz -np 8
+"""
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+import argparse
+import gzip
+import re
+import os
+
+import requests
+from configs import BUOYS, DATA_DIR, HISTORY_URL, BUOY_THREADS
+from cron_helper import logfile
+log = logfile("buoys.log")
+from ndbc import parse_history, merge_obs, read_store, write_store, store_name
+from get_buoys import make_session
+import telemetry
+
+HISTORY_DIR = f"{DATA_DIR}/history"
+
+# Month of a monthly file, as coded in its name (1-9, then a-c)
+MONTH_CODES = "123456789abc"
+
+def parse_name(fname):
+    """Station id, year and month (0 for yearly files) of a historical stdmet file.
+    Station ids are matched to the case used in BUOYS.
+    """
+    match = re.match(r"^(\w+?)([h1-9abc])(\d{4})\.txt(\.gz)?$",
+                     os.path.basename(fname).lower())
+    if match is None:
+        raise ValueError("Unrecognized historical file name %s" % (fname))
+    stn_id, period, year = match.group(1), match.group(2), int(match.group(3))
+    stations = dict((key.lower(), key) for key in BUOYS)
+    month = 0 if period == 'h' else MONTH_CODES.index(period) + 1
+    return stations.get(stn_id, stn_id.upper()), year, month
+
+def read_history(fname):
+    """Parse a historical stdmet file, gzipped or not.
+
+    Returns
+    -------
+    stn_id : str
+    data : dict or None
+        Parsed observations (see ndbc.parse_history). None if the file couldn't be
+        read.
+    """
+    stn_id = parse_name(fname)[0]
+    opener = gzip.open if fname.endswith('.gz') else open
+    try:
+        with opener(fname, 'rt') as f:
+            data = parse_history(f.read().splitlines())
+    except (OSError, ValueError, IndexError) as e:
+        log.error("Unable to parse %s: %s" % (fname, e))
+        return stn_id, None
+    log.info("Parsed %d observations from %s" % (len(data['time']), fname))
+    return stn_id, data
+
+@telemetry.stage('history')
+def ingest(files, data_dir=DATA_DIR, pool=None):
+    """Parse historical files and merge them into each station's store.
+
+    Parameters
+    ----------
+    files : list
+        Historical stdmet files
+    data_dir : str
+        Directory holding the stores
+    pool : multiprocessing.Pool, optional
+        Pool to parse the files with. Serial if not provided.
+
+    Returns
+    -------
+    stations : dict
+        Station id -> number of observations added or replaced
+    """
+    # Later files win where observations overlap, and yearly files supersede the
+    # monthly files of the same year
+    def order(fname):
+        stn_id, year, month = parse_name(fname)
+        return year, month or 13
+    files = sorted(files, key=order)
+    if pool is not None:
+        results = pool.map(read_history, files, chunksize=1)
+    else:
+        results = [read_history(f) for f in files]
+
+    history = {}
+    for stn_id, data in results:
+        if data is not None:
+            history[stn_id] = merge_obs(history.get(stn_id), data)
+
+    stations = {}
+    for stn_id, data in history.items():
+        store = store_name(data_dir, stn_id)
+        write_store(store, merge_obs(read_store(store), data))
+        stations[stn_id] = len(data['time'])
+        log.info("Ingested %d historical observations for %s" % (len(data['time']),
+                                                                 stn_id))
+    return stations
+
+def fetch_history(years, buoys=BUOYS, out_dir=None, base_url=HISTORY_URL,
+                  nthreads=BUOY_THREADS):
+    """Download the yearly historical files of each station. Files already downloaded
+    are kept, and years a station has no file for are skipped.
+
+    Returns
+    -------
+    files : list
+        Local files for every station and year available
+    """
+    out_dir = out_dir or HISTORY_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    session = make_session(nthreads)
+
+    def fetch(job):
+        stn_id, year = job
+        name = "%sh%d.txt.gz" % (stn_id.lower(), year)
+        fname = "%s/%s" % (out_dir, name)
+        if os.path.exists(fname):
+            return fname
+        url = "%s/%s" % (base_url.rstrip('/'), name)
+        try:
+            r = session.get(url, timeout=60)
+            if r.status_code == 404:
+                log.info("%s : not available" % (url))
+                return None
+            r.raise_for_status()
+        except requests.RequestException as e:
+            log.error("%s : %s" % (url, e))
+            return None
+        telemetry.count('bytes_downloaded', len(r.content), source='ndbc_history')
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(r.content)
+        os.replace(tmp, fname)
+        return fname
+
+    jobs = [(stn_id, year) for stn_id in buoys for year in years]
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        files = list(executor.map(fetch, jobs))
+    return [f for f in files if f is not None]
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-f', '--files', dest="files", nargs="+",
+                    help="Historical stdmet files to ingest")
+    ap.add_argument('-y', '--years', dest="years", nargs="+", type=int,
+                    help="Download and ingest these years for each of the BUOYS")
+    ap.add_argument('-np', '--nproc', dest='nproc', type=int,
+                    help="Number of processes to parse files with")
+    args = ap.parse_args()
+
+    telemetry.init('history')
+    files = list(args.files or [])
+    if args.years:
+        files.extend(fetch_history(args.years))
+    if args.nproc:
+        with Pool(args.nproc) as pool:
+            ingest(files, pool=pool)
+    else:
+        ingest(files)
+    telemetry.flush()
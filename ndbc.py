@@ -0,0 +1,214 @@
+"""
+Parsing and storage of NDBC standard meteorological observations. Parsed observations
+are kept in a compact columnar store (one .obs.npz file per station within DATA_DIR)
+so each run only has to parse the rows of the realtime2 text file that are newer than
+the last stored observation. Historical stdmet files (see history.py) are parsed into
+the same stores.
+"""
+import numpy as np
+import tempfile
+import os
+
+from cron_helper import logfile
+log = logfile("plots.log")
+
+STORE_EXT = ".obs.npz"
+
+# Observed variables of the realtime2 files. Historical files are given the same
+# columns, with any they lack (PTDY, and TIDE before 1999) as NaN.
+STDMET_COLUMNS = ['WDIR', 'WSPD', 'GST', 'WVHT', 'DPD', 'APD', 'MWD', 'PRES', 'ATMP',
+                  'WTMP', 'DEWP', 'VIS', 'PTDY', 'TIDE']
+
+# Column names used by older historical files
+RENAMED_COLUMNS = {'YYYY': 'YY', 'WD': 'WDIR', 'BAR': 'PRES'}
+
+# Historical files mark missing values with 9s rather than MM. Values at or above
+# these are missing.
+MISSING_VALUES = {'WDIR': 999, 'WSPD': 99, 'GST': 99, 'WVHT': 99, 'DPD': 99, 'APD': 99,
+                  'MWD': 999, 'PRES': 9999, 'ATMP': 999, 'WTMP': 999, 'DEWP': 999,
+                  'VIS': 99, 'TIDE': 99}
+
+# Stores already read by this process, keyed on filename: (mtime, data)
+_stores = {}
+
+def store_name(data_dir, stn_id):
+    """Location of the parsed-observation store for a station"""
+    return "%s/%s%s" % (data_dir, stn_id, STORE_EXT)
+
+def parse_header(line):
+    """Column names from the first header line of a stdmet file"""
+    return [name.lstrip('#') for name in line.split()]
+
+def make_time(year, month, day, hour, minute):
+    """Vectorized construction of datetime64[m] values from integer arrays"""
+    time = (year - 1970).astype('datetime64[Y]') + (month - 1).astype('timedelta64[M]')
+    time = time.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    return (time.astype('datetime64[m]') + hour.astype('timedelta64[h]')
+            + minute.astype('timedelta64[m]'))
+
+def parse_rows(lines, columns):
+    """Parse rows of a stdmet text file into typed columns.
+
+    Parameters
+    ----------
+    lines : list
+        Data rows (no header lines)
+    columns : list
+        Column names, starting with the YY MM DD hh (mm) date columns
+
+    Returns
+    -------
+    data : dict
+        float32 arrays for each of the observed variables, with missing (MM) values
+        as NaN, and datetime64[m] 'time'
+    """
+    ncols = len(columns)
+    values = np.array(" ".join(lines).replace('MM', 'nan').split(), dtype=np.float64)
+    values = values.reshape(-1, ncols)
+
+    ndate = 5 if columns[4] == 'mm' else 4
+    date = values[:, 0:ndate].astype(np.int64)
+    # Files before 1999 have 2-digit years
+    date[:, 0] = np.where(date[:, 0] < 100, date[:, 0] + 1900, date[:, 0])
+    minute = date[:, 4] if ndate == 5 else np.zeros(len(date), dtype=np.int64)
+    data = {'time': make_time(date[:, 0], date[:, 1], date[:, 2], date[:, 3], minute)}
+    for n, name in enumerate(columns[ndate:], ndate):
+        data[name] = values[:, n].astype(np.float32)
+    return data
+
+def parse_history(lines):
+    """Parse a historical stdmet file. Handles the 2-digit-year (before 1999) and
+    no-minute (before 2005) variants, the older column names and the units line.
+
+    Parameters
+    ----------
+    lines : list
+        Lines of the file, starting with the header
+
+    Returns
+    -------
+    data : dict
+        As parse_rows, with every one of STDMET_COLUMNS, sorted by time
+    """
+    columns = [RENAMED_COLUMNS.get(name, name) for name in parse_header(lines[0])]
+    rows = [line for line in lines[1:] if line.strip() and not line.startswith('#')]
+    parsed = parse_rows(rows, columns)
+    time, first = np.unique(parsed['time'], return_index=True)
+    data = {'time': time}
+    for name in STDMET_COLUMNS:
+        if name not in parsed:
+            data[name] = np.full(len(time), np.nan, dtype=np.float32)
+            continue
+        data[name] = parsed[name][first]
+        if name in MISSING_VALUES:
+            data[name][data[name] >= MISSING_VALUES[name]] = np.nan
+    return data
+
+def merge_obs(old, new):
+    """Combine two sets of observations, sorted by time. Where both contain the same
+    observation time, the values from new are kept. Either may be None, and neither
+    needs to be sorted.
+    """
+    if old is None and new is None: return None
+    if old is None or new is None:
+        sets = [new if old is None else old]
+    else:
+        sets = [new, old]
+    columns = [name for name in sets[0] if all(name in obs for obs in sets)]
+    time = np.concatenate([obs['time'] for obs in sets])
+    # np.unique returns the first occurrence of each time, which is from new
+    time, first = np.unique(time, return_index=True)
+    data = {'time': time}
+    for name in columns:
+        if name == 'time': continue
+        data[name] = np.concatenate([obs[name] for obs in sets])[first]
+    return data
+
+def read_store(fname):
+    """Read a parsed-observation store. Returns None if it doesn't exist. Stores this
+    process has already read are returned from memory unless changed on disk.
+    """
+    try:
+        mtime = os.path.getmtime(fname)
+        if fname in _stores and _stores[fname][0] == mtime:
+            return _stores[fname][1]
+        with np.load(fname, allow_pickle=False) as npz:
+            data = {name: npz[name] for name in npz.files}
+    except (OSError, ValueError):
+        return None
+    # Stores first parsed from a single text file were once kept newest-first
+    if np.any(np.diff(data['time']) < np.timedelta64(0, 'm')):
+        data = merge_obs(None, data)
+    _stores[fname] = (mtime, data)
+    return data
+
+def write_store(fname, data):
+    """Write a parsed-observation store via a temporary file and rename"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or ".", suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(tmp, fname)
+    _stores[fname] = (os.path.getmtime(fname), data)
+
+def update_station(data_dir, stn_id):
+    """Bring a station's parsed-observation store up to date with its realtime2 text
+    file and return the stored observations. The text file is newest-first, so only
+    the leading rows newer than the last stored observation are parsed.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory holding the realtime2 text files and the stores
+    stn_id : str
+        NDBC station id
+
+    Returns
+    -------
+    data : dict or None
+        Parsed observations (see parse_rows), sorted by time. None if there is no
+        data for the station.
+    """
+    fname = "%s/%s.txt" % (data_dir, stn_id)
+    store = store_name(data_dir, stn_id)
+    data = read_store(store)
+
+    try:
+        if data is not None and os.path.getmtime(fname) <= os.path.getmtime(store):
+            return data
+        with open(fname) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return data
+
+    if not lines or not lines[0].startswith('#'):
+        log.warning(f"Unrecognized format in {fname}")
+        return data
+    columns = parse_header(lines[0])
+    rows = [line for line in lines if line.strip() and not line.startswith('#')]
+
+    # Rows are newest-first. Stop at the first row already in the store.
+    if data is not None and all(name in data for name in columns[5:]):
+        last = data['time'][-1]
+        n = 0
+        for n, row in enumerate(rows):
+            date = tuple(int(v) for v in row.split(None, 5)[0:5])
+            if np.datetime64("%04d-%02d-%02dT%02d:%02d" % date) <= last:
+                break
+        else:
+            n = len(rows)
+        rows = rows[0:n]
+    else:
+        data = None
+
+    if rows:
+        try:
+            data = merge_obs(data, parse_rows(rows, columns))
+        except ValueError:
+            log.warning(f"Unable to parse {fname}")
+            return data
+        write_store(store, data)
+    elif data is not None:
+        # Nothing new. Mark the store as current with the text file.
+        os.utime(store)
+        _stores[store] = (os.path.getmtime(store), data)
+    return data
@@ -7,27 +7,63 @@ For realtime plots (and multiprocessing):
 For specific dates:
     python plots.py -np 8 -s 2020-10-01 -e 2020-10-08
 
+Lake-wide maps and an animated loop of the latest cycle:
+    python plots.py -np 8 --map
+
+Reading the model data from the consolidated archive (see archive.py):
+    python plots.py -np 8 -s 2020-10-01 -e 2020-10-08 -a
+
+For long date ranges, streaming keeps memory use flat however many cycles are read:
+    python plots.py -np 8 -s 2020-10-01 -e 2021-03-31 --stream
+
 How far out in time plots are created is controlled by variable FHR in the configs.py
 file. The long range WW3 model produces output out to 149 hours.
 """
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
+from functools import partial
 import numpy as np
-from scipy import spatial
-import xarray as xr
 import pandas as pd
 import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-from datetime import datetime, date, timedelta
+from matplotlib.dates import DateFormatter, date2num
+from datetime import datetime, timedelta
 import argparse
-from glob import glob
+import hashlib
+import json
 import os
 
 from configs import M2FT, MS2KT, BUOYS, DATA_DIR, PLOT_DIR, FHR, NUM_DAYS
-from configs import ww3_prop, buoy_prop, barb_prop, raw_buoy_prop
-from cron_helper import logfile
+from configs import NOW_GRANULARITY
+from configs import ww3_prop, buoy_prop, barb_prop, plume_prop
+from configs import map_prop, map_vector_prop, map_obs_prop, MAP_STRIDE, MAP_DPI
+from configs import MAP_FRAME_MS, PLOT_DPI, IMAGE_OUTPUTS
+from cron_helper import logfile, lockfile
 log = logfile("plots.log")
+from extract import load_points, find_files
+from extract import cached_points, cache_points, prune_points, stream_points
+from extract import grid_fingerprint
+from archive import load_cycles
+from plume import Plume, update as update_plume
+from ndbc import update_station
+import telemetry
+import grib
 
 SCRIPT_PATH = os.path.dirname(__file__) or "."
+MAP_DIR = f"{PLOT_DIR}/map"
+
+# Map frames rendered per task. Each task decodes only its own forecast hours.
+MAP_CHUNK = 12
+
+# Map frames only feed the animated loop, so they're saved with fast compression
+MAP_FRAME = {'suffix': '', 'width': None, 'format': 'png', 'compress_level': 1}
+
+# Threads per process encoding images, off the thread that draws them
+ENCODE_THREADS = 3
+
+# Render-input fingerprints of the last image made for each station, and the list of
+# images regenerated by the latest run
+FINGERPRINTS = "fingerprints.json"
+MANIFEST = "manifest.json"
 # --------------------------------------------------------------------------------------
 # Function definitions
 # --------------------------------------------------------------------------------------
@@ -76,56 +112,48 @@ def adjust_spines(ax, spines):
     else:
         ax.xaxis.set_ticks([])
 
-def read_ww3_data(filename):
-    """Read Wave Watch III grib2 data"""
-    log.info(f"Reading: {filename}")
+def read_buoy_data(data_dir, stn_id, start=None):
+    """Read NDBC Buoy data. Observations come from the station's parsed store (see
+    ndbc.update_station), which only parses text file rows newer than the last stored
+    observation.
 
-    data = {}
-    ds = xr.open_dataset(filename, engine='cfgrib')
+    Parameters
+    ----------
+    data_dir : str
+        Directory holding the NDBC text files
+    stn_id : str
+        NDBC station id
+    start : datetime, optional
+        Only return observations at or after this time
+    """
+    log.info(f"Plotting {stn_id}")
+    obs = update_station(data_dir, stn_id)
+    if obs is None:
+        return None
+    keep = slice(None)
+    if start is not None:
+        keep = obs['time'] >= np.datetime64(start, 'm')
+
+    wvhgt = obs['WVHT'][keep] * M2FT
+    #buoy_data_derived = pd.read_csv(data_dir + '/' + stn_id + '.dmv',
+    #                                delim_whitespace=True)[1:]
+    #wspd = pd.to_numeric(buoy_data_derived['WSPD10'], errors='coerce') * MS2KT
+
+    # Correct observed wind speeds to standard 10-m using log-wind profile
+    wspd_buoy = obs['WSPD'][keep] * MS2KT
+    wspd_adj = log_wind(wspd_buoy, BUOYS[stn_id][-1])
+
+    u, v = wind_components(1, obs['WDIR'][keep])
     data = {
-        'lons': ds.longitude.values - 360.,
-        'lats': ds.latitude.values,
-        'wvhgt': ds.swh.values * M2FT,
-        'wspd': ds.ws.values * MS2KT,
-        'time': pd.to_datetime(ds.valid_time.values),
-        'runtime': pd.to_datetime(ds.time.values)
+        'wvhgt': wvhgt,
+        'wspd_adj': wspd_adj,
+        'wspd': wspd_buoy,
+        'u': u,
+        'v': v,
+        'time': pd.to_datetime(obs['time'][keep])
     }
     return data
 
-def read_buoy_data(data_dir, stn_id):
-    """Read NDBC Buoy data from text file"""
-    try:
-        log.info(f"Plotting {stn_id}")
-        buoy_data = pd.read_csv(data_dir + '/' + stn_id + '.txt',
-                                delim_whitespace=True)[1:]
-        buoy_data['datestring'] = buoy_data['#YY'] + buoy_data['MM'] + buoy_data['DD'] \
-                                + buoy_data['hh'] + buoy_data['mm']
-        wvhgt = pd.to_numeric(buoy_data['WVHT'], errors='coerce') * M2FT
-        #buoy_data_derived = pd.read_csv(data_dir + '/' + stn_id + '.dmv',
-        #                                delim_whitespace=True)[1:]
-        #wspd = pd.to_numeric(buoy_data_derived['WSPD10'], errors='coerce') * MS2KT
-
-        # Correct observed wind speeds to standard 10-m using log-wind profile
-        wspd_buoy = pd.to_numeric(buoy_data['WSPD'], errors='coerce') * MS2KT
-        wspd_adj = log_wind(wspd_buoy, BUOYS[stn_id][-1])
-
-        wdir = pd.to_numeric(buoy_data['WDIR'], errors='coerce')
-        u, v = wind_components(1, wdir)
-        dt = pd.to_datetime(buoy_data['datestring'])
-
-        data = {
-            'wvhgt': wvhgt,
-            'wspd_adj': wspd_adj,
-            'wspd': wspd_buoy,
-            'u': u,
-            'v': v,
-            'time': dt
-        }
-    except (pd.errors.ParserError, pd.errors.EmptyDataError):
-        data = None
-
-    return data
-
 def log_wind(buoy_wind, buoy_height):
     """Convert buoy winds to 10-m reference height via log wind profile. This will work
     well in neutral stability environments. Not sure how accurate otherwise. Other
@@ -149,116 +177,544 @@ def log_wind(buoy_wind, buoy_height):
 
     return buoy_wind * (10. / buoy_height) ** 0.11
 
-def nearest_idx(points, lon, lat):
-    """Search for the nearest grid point using a KDTree
-
-    Parameters
-    ----------
-    points : list
-        List of lists indicating lon/lat pais: [[LON1, LAT1], [LON2, LAT2]]
-    lat : np.array
-        2-d array of gridded latitudes
-    lon : np.arrat
-        2-d array of gridded longitudes
+class StationFigure(object):
+    """Two-panel wave height and wind speed figure. The style, axes, labels and spine
+    styling are applied once, and each station is drawn by updating the data of the
+    existing line, scatter and quiver artists rather than building a new figure.
     """
-
-    lonlat = np.column_stack((lon.ravel(), lat.ravel()))
-    tree = spatial.cKDTree(lonlat)
-    dist, idx = tree.query(points, k=1)
-    ind = np.column_stack(np.unravel_index(idx, lon.shape))
-    return [(j,i) for j,i in ind]
-
-def main(start, end, nproc=None):
-    files = []
-    start1 = start
-    while start1 <= end:
-        date_string = datetime.strftime(start1, "%Y-%m-%d")
-        files.extend(glob("%s/%s/*.grib2" % (DATA_DIR, date_string)))
-        start1 += timedelta(days=1)
-    arr = []
-
-    if not nproc:
-        for f in files:
-            arr.append(read_ww3_data(f))
-    else:
-        pool = Pool(int(nproc))
-        arr = pool.map(read_ww3_data, files)
-
-    colors = plt.cm.Purples_r(np.linspace(0, 1, len(files)))
-    for stn_id in BUOYS.keys():
+    def __init__(self):
         plt.style.use('%s/style.mplstyle' % (SCRIPT_PATH))
-        fig, ax = plt.subplots(2, figsize=(20,8), sharex='col')
-        fig.subplots_adjust(hspace=0.15)
+        self.fig, self.ax = plt.subplots(2, figsize=(20,8), sharex='col')
+        self.fig.set_facecolor(plt.rcParams['savefig.facecolor'])
+        self.fig.subplots_adjust(hspace=0.15)
+        ax = self.ax
 
-        buoy_data = read_buoy_data(DATA_DIR, stn_id)
-        points = [BUOYS[stn_id][1], BUOYS[stn_id][0]]
-
-        # WW3 timeseries plots
-        for i in range(len(arr)):
-            if i == 0: idx = nearest_idx(points, arr[i]['lons'], arr[i]['lats'])
-            if i == len(arr)-1:
-                ww3_run = 'current'
-            else:
-                ww3_run = 'past'
-                ww3_prop['past']['color'] = colors[i]
-            ax[0].plot(arr[i]['time'][0:FHR], arr[i]['wvhgt'][0:FHR,idx[0][0],idx[0][1]],
-                       label=arr[i]['runtime'], **ww3_prop[ww3_run])
-            ax[1].plot(arr[i]['time'][0:FHR], arr[i]['wspd'][0:FHR,idx[0][0],idx[0][1]],
-                       **ww3_prop[ww3_run])
-
-        # Adding in buoy data
-        if buoy_data:
-            ax[1].quiver(buoy_data['time'], buoy_data['wspd_adj'], buoy_data['u'],
-                         buoy_data['v'], **barb_prop)
-            ax[1].scatter(buoy_data['time'], buoy_data['wspd_adj'], **buoy_prop)
-            #ax[1].scatter(buoy_data['time'], buoy_data['wspd'], **raw_buoy_prop)
-
-            # For stations that don't report wave heights
-            if np.nansum(buoy_data['wvhgt']) > 0:
-                ax[0].scatter(buoy_data['time'], buoy_data['wvhgt'], **buoy_prop,
-                              label=stn_id)
-            ax[1].xaxis.set_major_formatter(DateFormatter("%m/%d %H"))
-
-        # Set the axes limits
-        ax[0].set_ylim(0, arr[i]['wvhgt'][0:FHR,idx[0][0],idx[0][1]].max()+5)
-        ax[1].set_ylim(0, arr[i]['wspd'][0:FHR,idx[0][0],idx[0][1]].max()*2)
-        ax[1].set_xlim([start, end + timedelta(hours=FHR)])
+        ax[1].xaxis_date()
+        ax[1].xaxis.set_major_formatter(DateFormatter("%m/%d %H"))
         ax[0].set_ylabel('Significant Wave Height (ft)', fontsize=12)
         ax[1].set_ylabel('Wind Speed (kts) (10-m adjusted)', fontsize=12)
         ax[1].set_xlabel('Valid Date', fontsize=12)
 
-        # Adding vertical time reference
-        ymin, ymax = ax[0].get_ylim()
-        ax[0].vlines(NOW, ymin, ymax, linestyles='dashed', colors='#ffffff')
-        ax[0].text(NOW+timedelta(hours=1), ymax, NOW.strftime('%c'), color='red')
-        ymin, ymax = ax[1].get_ylim()
-        ax[1].vlines(NOW, ymin, ymax , linestyles='dashed', colors='#ffffff')
-
         # ------------------------------------------------------------------------------
-        # Adjusting x- and y-axes. Could be moved to a function.
+        # Adjusting x- and y-axes.
         # ------------------------------------------------------------------------------
-        ax[0].tick_params('both', length=7.5, width=2, which='major')
-        ax[0].spines['top'].set_color('none')
-        ax[0].spines['right'].set_color('none')
-        ax[0].spines['bottom'].set_linewidth(2)
-        ax[0].spines['left'].set_linewidth(2)
-        adjust_spines(ax[0], ['left', 'bottom'])
-
-        ax[1].tick_params('both', length=7.5, width=2, which='major')
-        ax[1].spines['top'].set_color('none')
-        ax[1].spines['right'].set_color('none')
-        ax[1].spines['bottom'].set_linewidth(2)
-        ax[1].spines['left'].set_linewidth(2)
-        adjust_spines(ax[1], ['left', 'bottom'])
-
-        plt.savefig("%s/%s.png" % (PLOT_DIR, stn_id), bbox_inches='tight', dpi=250)
-        plt.close()
+        for axis in ax:
+            axis.tick_params('both', length=7.5, width=2, which='major')
+            axis.spines['top'].set_color('none')
+            axis.spines['right'].set_color('none')
+            axis.spines['bottom'].set_linewidth(2)
+            axis.spines['left'].set_linewidth(2)
+            adjust_spines(axis, ['left', 'bottom'])
+
+        # WW3 lines are created as needed and reused between stations
+        self.lines = [[], []]
+        self.obs = [ax[0].scatter([], [], **buoy_prop), ax[1].scatter([], [], **buoy_prop)]
+        self.barbs = None
+        self.bands = []
+
+        # Vertical time reference
+        self.now_lines = [axis.axvline(0, linestyle='dashed', color='#ffffff')
+                          for axis in ax]
+        self.now_text = ax[0].text(0, 0, '', color='red')
+
+    def set_model(self, series):
+        """Update the WW3 lines. series is a list of (time, wvhgt, wspd) for each cycle,
+        oldest first. The final cycle is drawn as the current run.
+        """
+        colors = plt.cm.Purples_r(np.linspace(0, 1, len(series)))
+        for n, axis in enumerate(self.ax):
+            lines = self.lines[n]
+            while len(lines) < len(series):
+                lines.append(axis.plot([], [])[0])
+            for i, line in enumerate(lines):
+                if i >= len(series):
+                    line.set_visible(False)
+                    continue
+                if i == len(series)-1:
+                    prop = ww3_prop['current']
+                else:
+                    prop = dict(ww3_prop['past'], color=colors[i])
+                line.set(visible=True, zorder=2 if i == len(series)-1 else 1, **prop)
+                line.set_data(date2num(series[i][0]), series[i][n+1])
+
+    def set_plume(self, band):
+        """Update the shaded min-max bands of the forecast plume. band is
+        (valid, {var: (min, max)}), as returned by plume.Plume.band.
+        """
+        for collection in self.bands:
+            collection.remove()
+        self.bands = []
+        if band is None:
+            return
+        valid, values = band
+        x = date2num(valid)
+        for axis, var in zip(self.ax, ['wvhgt', 'wspd']):
+            lo, hi = values[var]
+            self.bands.append(axis.fill_between(x, lo, hi, **plume_prop))
+
+    def set_obs(self, buoy_data):
+        """Update the buoy observations and wind barbs"""
+        if self.barbs is not None:
+            self.barbs.remove()
+            self.barbs = None
+        empty = np.empty((0, 2))
+        if not buoy_data:
+            for scatter in self.obs: scatter.set_offsets(empty)
+            return
+
+        x = date2num(buoy_data['time'])
+        self.barbs = self.ax[1].quiver(x, buoy_data['wspd_adj'], buoy_data['u'],
+                                       buoy_data['v'], **barb_prop)
+        self.obs[1].set_offsets(np.column_stack((x, buoy_data['wspd_adj'])))
+
+        # For stations that don't report wave heights
+        if np.nansum(buoy_data['wvhgt']) > 0:
+            self.obs[0].set_offsets(np.column_stack((x, buoy_data['wvhgt'])))
+        else:
+            self.obs[0].set_offsets(empty)
+
+    def set_limits(self, start, end, now, wvhgt, wspd):
+        """Axes limits from the current run, and the vertical time reference"""
+        self.ax[0].set_ylim(0, np.nanmax(wvhgt)+5)
+        self.ax[1].set_ylim(0, np.nanmax(wspd)*2)
+        self.ax[1].set_xlim([start, end + timedelta(hours=FHR)])
+        for line in self.now_lines:
+            line.set_xdata([date2num(now)] * 2)
+        self.now_text.set_position((date2num(now+timedelta(hours=1)),
+                                    self.ax[0].get_ylim()[1]))
+        self.now_text.set_text(now.strftime('%c'))
+
+    def draw(self, series, buoy_data, start, end, now, band=None):
+        self.set_model(series)
+        self.set_plume(band)
+        self.set_obs(buoy_data)
+        self.set_limits(start, end, now, series[-1][1], series[-1][2])
+
+# --------------------------------------------------------------------------------------
+# Image output. Figures are drawn once, and every output is encoded from that one image.
+# --------------------------------------------------------------------------------------
+# Encoding threads of this process, created on first use
+_encoder = None
+
+def _reset_encoder():
+    # A forked child inherits the executor but not its threads, and would wait forever
+    # on anything submitted to it
+    global _encoder
+    _encoder = None
+
+os.register_at_fork(after_in_child=_reset_encoder)
+
+def rasterize(fig, dpi, tight=False, pad=0.1):
+    """Draw a figure once and return its pixels as an (y, x, 3) uint8 array. With
+    tight, the image is cropped to the figure's content plus pad inches, as savefig
+    does with bbox_inches='tight', but without its extra draw.
+    """
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    pixels = np.asarray(fig.canvas.buffer_rgba())[:, :, 0:3]
+    if tight:
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(pad)
+        x0, y0, x1, y1 = np.round(np.array(bbox.extents) * dpi).astype(int)
+        # Rows run down from the top of the figure. Content beyond the canvas is lost.
+        height, width = pixels.shape[0:2]
+        pixels = pixels[max(height - y1, 0):height - max(y0, 0),
+                        max(x0, 0):min(x1, width)]
+    # The canvas buffer is reused by the next draw
+    return pixels.copy()
+
+def output_files(base, outputs=IMAGE_OUTPUTS):
+    """Filenames of each of outputs, from a filename without its extension"""
+    return ["%s%s.%s" % (base, output['suffix'], output['format']) for output in
+            outputs]
+
+def save_image(pixels, fname, output):
+    """Encode pixels to fname as described by output (see configs.IMAGE_OUTPUTS),
+    replacing any existing image atomically
+    """
+    from PIL import Image
+
+    image = Image.fromarray(pixels)
+    width = output.get('width')
+    if width and width < image.width:
+        size = (width, int(round(image.height * width / image.width)))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    if output.get('colors'):
+        image = image.quantize(output['colors'], method=Image.Quantize.FASTOCTREE)
+    options = dict((key, value) for key, value in output.items() if key not in
+                   ['suffix', 'width', 'format', 'colors'])
+    tmp = fname + '.tmp'
+    image.save(tmp, format=output['format'].upper(), **options)
+    os.replace(tmp, fname)
+    return fname
+
+def save_outputs(pixels, base, outputs=IMAGE_OUTPUTS):
+    """Encode each of outputs from one image, on this process's encoding threads.
+
+    Returns
+    -------
+    futures : list
+        concurrent.futures.Future of each output's filename
+    """
+    global _encoder
+    if _encoder is None:
+        _encoder = ThreadPoolExecutor(max_workers=ENCODE_THREADS)
+    return [_encoder.submit(save_image, pixels, fname, output) for fname, output in
+            zip(output_files(base, outputs), outputs)]
+
+# Figure template for this process, created on first use
+_figure = None
+
+def render_station(task):
+    """Draw the figure for a single station and save each of IMAGE_OUTPUTS. Runs
+    within the pool workers, each of which builds its StationFigure once and reuses it
+    for every station.
+
+    Parameters
+    ----------
+    task : tuple
+        (stn_id, series, start, end, now, band). series is a list of (time, wvhgt,
+        wspd) model series at the station for each cycle, oldest first. band is the
+        station's forecast plume (see plume.Plume.band).
+
+    Returns
+    -------
+    images : list
+        Images that were written
+    """
+    global _figure
+    stn_id, series, start, end, now, band = task
+    if _figure is None:
+        _figure = StationFigure()
+    buoy_data = read_buoy_data(DATA_DIR, stn_id, start)
+    _figure.draw(series, buoy_data, start, end, now, band)
+    pixels = rasterize(_figure.fig, PLOT_DPI, tight=True)
+    futures = save_outputs(pixels, "%s/%s" % (PLOT_DIR, stn_id))
+    return [future.result() for future in futures]
+
+def round_time(dt, minutes=NOW_GRANULARITY):
+    """Round a datetime down to the nearest number of minutes"""
+    dt = dt.replace(second=0, microsecond=0)
+    return dt - timedelta(minutes=(dt.hour * 60 + dt.minute) % minutes)
+
+def style_fingerprint():
+    """Hash of the plot styling configuration"""
+    with open('%s/style.mplstyle' % (SCRIPT_PATH)) as f:
+        style = f.read()
+    config = [style, ww3_prop, buoy_prop, barb_prop, plume_prop, FHR, NUM_DAYS,
+              PLOT_DPI, IMAGE_OUTPUTS]
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def station_fingerprint(stn_id, cycles, start, end, now, style):
+    """Hash of everything that goes into a station's plot: its metadata, the latest
+    buoy observation, the model cycles (and their file modification times), the plot
+    range, the NOW reference line and the styling configuration.
+    """
+    obs = update_station(DATA_DIR, stn_id)
+    last_obs = str(obs['time'][-1]) if obs is not None and len(obs['time']) else None
+    inputs = [BUOYS[stn_id], last_obs, cycles, str(start), str(end), str(now), style]
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+def read_json(fname, default):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json(fname, data):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, fname)
+
+def main(start, end, nproc=None, now=None, pool=None, force=False, archive=False,
+         stream=False):
+    """Create the forecast and observation plots for each of the BUOYS. Stations whose
+    render inputs haven't changed since their last plot (see station_fingerprint) are
+    skipped. The images that were regenerated are listed in PLOT_DIR/manifest.json,
+    along with the model cycles (YYYY-MM-DD/HH) they were drawn from.
+
+    Parameters
+    ----------
+    start, end : datetime
+        Range of dates to plot WW3 cycles for
+    nproc : int, optional
+        Number of processes to read WW3 data and render plots with. Serial if not
+        provided.
+    now : datetime, optional
+        Time of the vertical reference line. Default is the current time.
+    pool : multiprocessing.Pool, optional
+        Existing pool to use instead of starting one with nproc
+    force : bool
+        Re-render every station, regardless of fingerprints
+    archive : bool
+        Read the model series from the consolidated archive (see archive.py) rather
+        than the grib2 files
+    stream : bool
+        Read the grib2 files a window at a time (see extract.stream_points), keeping
+        only each station's series rather than every cycle, and bypassing the
+        in-process cache. For long date ranges.
+
+    Returns
+    -------
+    images : list
+        Images that were regenerated
+    """
+    if pool is None and nproc:
+        with Pool(int(nproc)) as pool:
+            return main(start, end, now=now, pool=pool, force=force, archive=archive,
+                        stream=stream)
+
+    t1 = datetime.now()
+    now = round_time(now or t1)
+    start, end = round_time(start), round_time(end)
+
+    # Model series at the buoy locations come from memory if this process has already
+    # read them, and then from the point-extraction sidecars. Only cycles without a
+    # current sidecar are decoded from the grib2 files, within the worker processes
+    # when running in parallel. In archive mode they're read from the consolidated
+    # store instead. Either way, only each station's (time, wvhgt, wspd) series is kept
+    # for every cycle. The realtime forecast plume is updated incrementally with any
+    # new cycles (see plume.py), while archive and streamed ranges get one of their own.
+    series = dict((stn_id, []) for stn_id in BUOYS)
+    with telemetry.stage('read_model'):
+        if archive:
+            arr = load_cycles(start, end, fhr=FHR)
+            cycles = [str(d['runtime']) for d in arr]
+        elif stream:
+            files = find_files(start, end)
+            cycles = [[os.path.basename(f), os.path.getmtime(f)] for f in files]
+            arr = (data for f, data in stream_points(files, fhr=FHR, pool=pool))
+        else:
+            files = find_files(start, end)
+            prune_points(files)
+            missing = [f for f in files if cached_points(f, fhr=FHR) is None]
+            if missing and pool is not None:
+                results = pool.map(partial(load_points, fhr=FHR), missing)
+                for f, data in zip(missing, results):
+                    cache_points(f, data, fhr=FHR)
+            arr = [load_points(f, fhr=FHR) for f in files]
+            cycles = [[os.path.basename(f), os.path.getmtime(f)] for f in files]
+        plume = Plume(fhr=FHR)
+        runtimes = []
+        for d in arr:
+            runtimes.append(pd.Timestamp(d['runtime']).strftime('%Y-%m-%d/%H'))
+            for stn_id in BUOYS:
+                series[stn_id].append((d['time'], d['wvhgt'][stn_id], d['wspd'][stn_id]))
+            if archive or stream:
+                plume.add(d)
+        if not (archive or stream):
+            plume = update_plume(arr, start)
+
+    # One rendering task per station whose inputs have changed, carrying only that
+    # station's model series
+    fingerprint_file = "%s/%s" % (PLOT_DIR, FINGERPRINTS)
+    fingerprints = read_json(fingerprint_file, {})
+    style = style_fingerprint()
+    tasks = []
+    for stn_id in BUOYS.keys():
+        fingerprint = station_fingerprint(stn_id, cycles, start, end, now, style)
+        images = output_files("%s/%s" % (PLOT_DIR, stn_id))
+        if not force and fingerprints.get(stn_id) == fingerprint and \
+           all(os.path.exists(image) for image in images):
+            continue
+        fingerprints[stn_id] = fingerprint
+        tasks.append((stn_id, series[stn_id], start, end, now, plume.band(stn_id)))
+
+    with telemetry.stage('render'):
+        if pool is not None:
+            rendered = pool.map(render_station, tasks, chunksize=1)
+        else:
+            rendered = [render_station(task) for task in tasks]
+    images = [image for result in rendered for image in result]
+    telemetry.count('images_rendered', len(images))
+    telemetry.count('files_skipped', len(BUOYS) - len(rendered), stage='plots')
+    write_json(fingerprint_file, fingerprints)
+    write_json("%s/%s" % (PLOT_DIR, MANIFEST), {'time': str(t1), 'images': images,
+                                                'cycles': runtimes})
+    log.info(f"Rendered {len(rendered)} of {len(BUOYS)} stations")
 
     t2 = datetime.now()
     delta = t2 - t1
     print("===========================================================================")
     log.info(f"Completed Plotting in {delta.total_seconds()} seconds")
     print("===========================================================================")
+    return images
+
+# --------------------------------------------------------------------------------------
+# Lake-wide maps
+# --------------------------------------------------------------------------------------
+class MapFigure(object):
+    """Wave height shading with wind vectors and observed wave heights over the model
+    grid. The mesh, shoreline, colorbar and vector positions are built once, and each
+    frame only swaps the data arrays.
+    """
+    def __init__(self, lat, lon, mask):
+        plt.style.use('%s/style.mplstyle' % (SCRIPT_PATH))
+        self.fig, self.ax = plt.subplots(figsize=(10, 10))
+        self.fig.set_facecolor(plt.rcParams['savefig.facecolor'])
+        ax = self.ax
+        lon = lon - 360.
+        ax.set_aspect(1. / np.cos(np.deg2rad(np.mean(lat))))
+        ax.set_xlim(np.min(lon), np.max(lon))
+        ax.set_ylim(np.min(lat), np.max(lat))
+
+        self.mesh = ax.pcolormesh(lon, lat, np.ma.masked_all(lat.shape),
+                                  shading='nearest', **map_prop)
+        cbar = self.fig.colorbar(self.mesh, ax=ax, shrink=0.8, pad=0.02)
+        cbar.set_label('Significant Wave Height (ft)', fontsize=12)
+
+        # The shoreline is the edge of the model's water points
+        ax.contour(lon, lat, mask.astype(np.float32), levels=[0.5], colors='#d9d9d9',
+                   linewidths=1)
+
+        self.stride = (slice(None, None, MAP_STRIDE),) * 2
+        zeros = np.zeros(lat[self.stride].shape)
+        self.vectors = ax.quiver(lon[self.stride], lat[self.stride], zeros, zeros,
+                                 **map_vector_prop)
+        self.obs = ax.scatter([], [], c=[], cmap=self.mesh.cmap, norm=self.mesh.norm,
+                              **map_obs_prop)
+        self.title = ax.set_title('', fontsize=12)
+
+    def draw(self, wvhgt, u, v, obs, title):
+        """Swap in a frame's data. obs is an (n, 3) array of lon, lat, wave height"""
+        self.mesh.set_array(np.ma.masked_invalid(wvhgt))
+        self.vectors.set_UVC(np.ma.masked_invalid(u[self.stride]),
+                             np.ma.masked_invalid(v[self.stride]))
+        self.obs.set_offsets(obs[:, 0:2])
+        self.obs.set_array(obs[:, 2])
+        self.title.set_text(title)
+
+# Map template for this process and the grid it was built for, created on first use
+_map = (None, None)
+
+def render_map(task):
+    """Decode a range of a cycle's forecast hours and save a map frame for each. Runs
+    within the pool workers, each of which builds its MapFigure once.
+
+    Parameters
+    ----------
+    task : tuple
+        (filename, first, last, obs, out_dir). Forecast steps first through last - 1
+        are rendered. obs holds the observations for each of those steps (see
+        map_obs).
+
+    Returns
+    -------
+    frames : list
+        Images that were written
+    """
+    global _map
+    filename, first, last, obs, out_dir = task
+    data = grib.read_grib(filename, ['swh', 'ws', 'wdir'], fhr=last, first=first)
+    lat, lon = grib.read_grid(filename)
+    fingerprint = grid_fingerprint(lon, lat)
+    if _map[0] != fingerprint:
+        _map = (fingerprint, MapFigure(lat, lon, ~np.isnan(data['swh'][0])))
+    figure = _map[1]
+
+    # Each frame is encoded while the next is drawn
+    runtime = pd.Timestamp(data['runtime'])
+    futures = []
+    for n, valid in enumerate(pd.DatetimeIndex(data['time'])):
+        u, v = wind_components(data['ws'][n] * MS2KT, data['wdir'][n])
+        hour = int((valid - runtime) / pd.Timedelta(hours=1))
+        title = "GLWU %s  F%03d  Valid: %s" % (runtime.strftime('%Y-%m-%d %HZ'), hour,
+                                                valid.strftime('%a %m/%d %HZ'))
+        figure.draw(data['swh'][n] * M2FT, u, v, obs[n], title)
+        base = "%s/map_%03d" % (out_dir, first + n)
+        futures.extend(save_outputs(rasterize(figure.fig, MAP_DPI), base, [MAP_FRAME]))
+    return [future.result() for future in futures]
+
+def map_obs(valid, data_dir=DATA_DIR, tolerance=30):
+    """Observed wave heights (ft) nearest each valid time, within tolerance minutes.
+
+    Returns
+    -------
+    obs : list
+        (n, 3) array of lon, lat and wave height for each valid time
+    """
+    valid = pd.DatetimeIndex(valid)
+    stations = []
+    for stn_id, (lat, lon, height) in BUOYS.items():
+        store = update_station(data_dir, stn_id)
+        if store is None:
+            continue
+        wvhgt = pd.Series(store['WVHT'] * M2FT, index=pd.DatetimeIndex(store['time']))
+        wvhgt = wvhgt.dropna()
+        if len(wvhgt):
+            nearest = wvhgt.reindex(valid, method='nearest',
+                                    tolerance=pd.Timedelta(minutes=tolerance))
+            stations.append((lon, lat, nearest.values))
+
+    obs = []
+    for n in range(len(valid)):
+        points = [(lon, lat, values[n]) for lon, lat, values in stations
+                  if not np.isnan(values[n])]
+        obs.append(np.array(points, dtype=np.float64).reshape(-1, 3))
+    return obs
+
+def animate(frames, fname, duration=MAP_FRAME_MS):
+    """Assemble frames into a looping animated GIF"""
+    from PIL import Image
+
+    images = [Image.open(frame).convert('RGB').quantize(
+              method=Image.Quantize.FASTOCTREE) for frame in frames]
+    tmp = fname + '.tmp'
+    images[0].save(tmp, format='GIF', save_all=True, append_images=images[1:],
+                   duration=duration, loop=0)
+    os.replace(tmp, fname)
+
+def make_maps(filename, nproc=None, pool=None, fhr=FHR, out_dir=None):
+    """Render a map of every forecast hour of a cycle through fhr, in parallel if given
+    a pool, and assemble them into PLOT_DIR/map/map.gif.
+
+    Parameters
+    ----------
+    filename : str
+        WW3 grib2 file
+    nproc : int, optional
+        Number of processes to render frames with. Serial if not provided.
+    pool : multiprocessing.Pool, optional
+        Existing pool to use instead of starting one with nproc
+    fhr : int
+        Number of forecast hours
+    out_dir : str, optional
+        Default: MAP_DIR
+
+    Returns
+    -------
+    images : list
+        The frames and the animated loop
+    """
+    if pool is None and nproc:
+        with Pool(int(nproc)) as pool:
+            return make_maps(filename, pool=pool, fhr=fhr, out_dir=out_dir)
+
+    t1 = datetime.now()
+    out_dir = out_dir or MAP_DIR
+    os.makedirs(out_dir, exist_ok=True)
+
+    messages = grib.inventory(filename)
+    steps = sorted(set(m[2] for m in messages))[0:fhr]
+    valid = [pd.Timestamp(messages[0][3]) + pd.Timedelta(hours=step) for step in steps]
+    obs = map_obs(valid)
+    tasks = [(filename, n, min(n + MAP_CHUNK, len(steps)), obs[n:n + MAP_CHUNK],
+              out_dir) for n in range(0, len(steps), MAP_CHUNK)]
+
+    with telemetry.stage('map'):
+        if pool is not None:
+            results = pool.map(render_map, tasks, chunksize=1)
+        else:
+            results = [render_map(task) for task in tasks]
+        frames = [frame for result in results for frame in result]
+        loop = "%s/map.gif" % (out_dir)
+        animate(frames, loop)
+    telemetry.count('images_rendered', len(frames) + 1, stage='map')
+
+    delta = datetime.now() - t1
+    log.info(f"Rendered {len(frames)} map frames in {delta.total_seconds()} seconds")
+    return frames + [loop]
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
@@ -266,9 +722,16 @@ if __name__ == '__main__':
     ap.add_argument('-e', '--end', dest="end", help="YYYY-MM-DD")
     ap.add_argument('-np', '--nproc', dest='nproc',
                     help="If using mproc for data read, specify number of cores")
+    ap.add_argument('-f', '--force', dest='force', action='store_true',
+                    help="Re-render every station, even if its inputs are unchanged")
+    ap.add_argument('-a', '--archive', dest='archive', action='store_true',
+                    help="Read model data from the consolidated archive (archive.py)")
+    ap.add_argument('--stream', dest='stream', action='store_true',
+                    help="Stream the grib2 files with bounded memory, for long ranges")
+    ap.add_argument('-m', '--map', dest='map', action='store_true',
+                    help="Render lake-wide maps of the latest cycle in the range")
     args = ap.parse_args()
 
-    t1 = datetime.now()
     log.info("Begin WW3 Plotting routines...")
     NOW = datetime.now()
     if args.start is not None:
@@ -281,4 +744,16 @@ if __name__ == '__main__':
     else:
         end = parse_time(NOW)
 
-    main(start, end, nproc=args.nproc)
+    # Serialize against run.py, which would otherwise write the same images
+    telemetry.init('plots')
+    with lockfile('plots'), telemetry.stage('plots'):
+        if args.map:
+            files = find_files(start, end)
+            if files:
+                make_maps(files[-1], nproc=args.nproc)
+            else:
+                log.warning(f"No cycles between {start} and {end} to map")
+        else:
+            main(start, end, nproc=args.nproc, now=NOW, force=args.force,
+                 archive=args.archive, stream=args.stream)
+    telemetry.flush()
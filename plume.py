@@ -0,0 +1,281 @@
+"""
+Run-to-run consistency (forecast plume) product. For each station and valid time, the
+number of overlapping cycles and the min, max, mean and standard deviation of their
+wave height and wind speed forecasts, along with the trend (latest minus previous
+cycle).
+
+Statistics are maintained incrementally. Only cycles that still overlap the newest one
+are kept, aligned on valid time, so adding a cycle only recomputes the valid times it
+covers, from at most FHR / 12 + 1 cycles, however long the window is. Valid times
+before the newest cycle's first step are final.
+
+To update the plume with the last NUM_DAYS of cycles and export it as csv files:
+    python plume.py
+    python plume.py -o /path/to/output
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import argparse
+import tempfile
+import os
+
+from configs import BUOYS, DATA_DIR, PLOT_DIR, FHR, NUM_DAYS
+from cron_helper import logfile
+log = logfile("plots.log")
+from extract import load_points, find_files, station_key
+
+PLUME = f"{DATA_DIR}/plume.npz"
+PLUME_DIR = f"{PLOT_DIR}/plume"
+PLUME_VARS = ['wvhgt', 'wspd']
+STATS = ['n', 'min', 'max', 'mean', 'std', 'trend']
+
+# Bumped when the stored layout changes, so older stores are rebuilt
+PLUME_VERSION = 1
+
+HOUR = np.timedelta64(1, 'h')
+
+def plume_stats(aligned):
+    """Statistics across cycles of a (cycle, station, valid time) array.
+
+    Parameters
+    ----------
+    aligned : np.array
+        Forecasts aligned on valid time, oldest cycle first, NaN where a cycle doesn't
+        cover a valid time
+
+    Returns
+    -------
+    stats : dict
+        (station, valid time) arrays of each of STATS. std is the population standard
+        deviation. trend is NaN where fewer than two cycles overlap.
+    """
+    ok = ~np.isnan(aligned)
+    n = ok.sum(axis=0)
+    values = np.where(ok, aligned, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = values.sum(axis=0) / n
+        std = np.sqrt(np.where(ok, (aligned - mean) ** 2, 0.).sum(axis=0) / n)
+    vmin = np.where(ok, aligned, np.inf).min(axis=0)
+    vmax = np.where(ok, aligned, -np.inf).max(axis=0)
+
+    # Rows of the latest and previous cycles covering each valid time
+    count = ok.cumsum(axis=0)
+    latest = np.argmax(ok & (count == n), axis=0)
+    previous = np.argmax(ok & (count == n - 1), axis=0)
+    trend = (np.take_along_axis(aligned, latest[None], axis=0)[0] -
+             np.take_along_axis(aligned, previous[None], axis=0)[0])
+
+    empty = n == 0
+    return {
+        'n': n.astype(np.float32),
+        'min': np.where(empty, np.nan, vmin).astype(np.float32),
+        'max': np.where(empty, np.nan, vmax).astype(np.float32),
+        'mean': mean.astype(np.float32),
+        'std': std.astype(np.float32),
+        'trend': np.where(n < 2, np.nan, trend).astype(np.float32),
+    }
+
+class Plume(object):
+    """Plume statistics for every station, aligned on an hourly valid-time axis"""
+    def __init__(self, buoys=BUOYS, fhr=FHR):
+        self.stations = list(buoys.keys())
+        self.keys = [station_key(*buoys[stn_id][0:2]) for stn_id in self.stations]
+        self.fhr = fhr
+        self.valid = np.array([], dtype='datetime64[h]')
+        self.stats = dict(((var, stat), np.empty((len(self.stations), 0),
+                          dtype=np.float32)) for var in PLUME_VARS for stat in STATS)
+
+        # Every cycle added, and the forecasts of those still overlapping the latest
+        self.runtimes = np.array([], dtype='datetime64[h]')
+        self.live = np.array([], dtype='datetime64[h]')
+        self.forecasts = dict((var, np.empty((0, len(self.stations), fhr),
+                               dtype=np.float32)) for var in PLUME_VARS)
+
+    @property
+    def latest(self):
+        return self.runtimes.max() if len(self.runtimes) else None
+
+    def extend(self, last):
+        """Extend the valid-time axis through last"""
+        first = self.valid[0] if len(self.valid) else self.live[-1]
+        nvalid = int((last - first) // HOUR) + 1
+        grow = nvalid - len(self.valid)
+        if grow <= 0:
+            return
+        self.valid = first + np.arange(nvalid) * HOUR
+        for key, values in self.stats.items():
+            pad = np.full((len(self.stations), grow), np.nan, dtype=np.float32)
+            self.stats[key] = np.concatenate((values, pad), axis=1)
+
+    def add(self, data):
+        """Add a cycle, recomputing the valid times it covers.
+
+        Parameters
+        ----------
+        data : dict
+            Model series of the cycle, as returned by extract.load_points
+
+        Returns
+        -------
+        added : bool
+            False if the cycle was already in the plume
+
+        Raises
+        ------
+        ValueError
+            If the cycle is older than the latest cycle in the plume
+        """
+        runtime = np.datetime64(data['runtime'], 'h')
+        if runtime in self.runtimes:
+            return False
+        if (self.latest is not None and runtime < self.latest) or \
+           (len(self.valid) and runtime < self.valid[0]):
+            raise ValueError("Cycle %s is older than the plume" % (runtime))
+
+        # Cycles ending before this one starts no longer overlap any valid time it
+        # could change
+        keep = self.live + (self.fhr - 1) * HOUR >= runtime
+        self.live = np.append(self.live[keep], runtime)
+        time = np.asarray(data['time'], dtype='datetime64[h]')[0:self.fhr]
+        step = ((time - runtime) // HOUR).astype(int)
+        for var in PLUME_VARS:
+            values = np.full((len(self.stations), self.fhr), np.nan, dtype=np.float32)
+            values[:, step] = np.stack([data[var][stn_id][0:len(step)]
+                                        for stn_id in self.stations])
+            self.forecasts[var] = np.concatenate((self.forecasts[var][keep],
+                                                  values[None]))
+        self.runtimes = np.append(self.runtimes, runtime)
+        self.extend(runtime + (self.fhr - 1) * HOUR)
+
+        # (cycle, station, valid time) over this cycle's valid times
+        offset = ((self.live - runtime) // HOUR).astype(int)
+        cols = int((runtime - self.valid[0]) // HOUR) + np.arange(self.fhr)
+        for var in PLUME_VARS:
+            aligned = np.full((len(self.live), len(self.stations), self.fhr), np.nan,
+                              dtype=np.float32)
+            forecasts = self.forecasts[var]
+            for row, shift in enumerate(offset):
+                aligned[row, :, 0:self.fhr + shift] = forecasts[row, :, -shift:]
+            for stat, values in plume_stats(aligned).items():
+                self.stats[(var, stat)][:, cols] = values
+        return True
+
+    def prune(self, start):
+        """Drop valid times before start, and the record of cycles ending before it"""
+        start = np.datetime64(start, 'h')
+        self.runtimes = self.runtimes[self.runtimes + self.fhr * HOUR > start]
+        drop = int(np.sum(self.valid < start))
+        if drop:
+            self.valid = self.valid[drop:]
+            for key, values in self.stats.items():
+                self.stats[key] = values[:, drop:]
+
+    def station(self, stn_id):
+        """Plume of a single station as a DataFrame indexed by valid time, with a
+        VAR_STAT column for each variable and statistic.
+        """
+        row = self.stations.index(stn_id)
+        columns = dict(("%s_%s" % key, values[row]) for key, values in
+                       self.stats.items())
+        return pd.DataFrame(columns, index=pd.DatetimeIndex(self.valid, name='valid'))
+
+    def band(self, stn_id):
+        """(valid, {var: (min, max)}) for drawing a station's plume as a shaded band"""
+        row = self.stations.index(stn_id)
+        return (self.valid.astype('datetime64[m]'),
+                dict((var, (self.stats[(var, 'min')][row],
+                            self.stats[(var, 'max')][row])) for var in PLUME_VARS))
+
+    def save(self, path=None):
+        """Write the plume to path (default: PLUME), replacing it atomically"""
+        path = path or PLUME
+        arrays = dict(("%s_%s" % key, values) for key, values in self.stats.items())
+        arrays.update(("live_%s" % var, values) for var, values in
+                      self.forecasts.items())
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=PLUME_VERSION, keys=np.array(self.keys), fhr=self.fhr,
+                     valid=self.valid, runtimes=self.runtimes, live=self.live,
+                     **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=None, buoys=BUOYS, fhr=FHR):
+        """Read a saved plume. None if it's missing, from an older PLUME_VERSION, or
+        for different stations or forecast hours.
+        """
+        plume = cls(buoys, fhr)
+        try:
+            with np.load(path or PLUME, allow_pickle=False) as npz:
+                if int(npz['version']) != PLUME_VERSION or int(npz['fhr']) != fhr or \
+                   list(npz['keys']) != plume.keys:
+                    return None
+                plume.valid = npz['valid']
+                plume.runtimes = npz['runtimes']
+                plume.live = npz['live']
+                for var in PLUME_VARS:
+                    plume.forecasts[var] = npz['live_%s' % (var)]
+                    for stat in STATS:
+                        plume.stats[(var, stat)] = npz['%s_%s' % (var, stat)]
+        except (OSError, KeyError, ValueError):
+            return None
+        return plume
+
+def update(cycles, start=None, path=None, buoys=BUOYS, fhr=FHR):
+    """Add any new cycles to the stored plume. Cycles older than the latest in the
+    store (say, from a backfill) can't be added incrementally, so the plume is then
+    rebuilt from all of the cycles given.
+
+    Parameters
+    ----------
+    cycles : list
+        Model series of each cycle, as returned by extract.load_points
+    start : datetime, optional
+        Drop valid times before start. Cycles ending before start are ignored.
+    path : str, optional
+        Location of the store. Default: PLUME
+
+    Returns
+    -------
+    plume : Plume
+    """
+    runtime = lambda d: np.datetime64(d['runtime'], 'h')
+    cycles = sorted(cycles, key=runtime)
+    if start is not None:
+        start = np.datetime64(start, 'h')
+        cycles = [d for d in cycles if runtime(d) + fhr * HOUR > start]
+
+    plume = Plume.load(path, buoys, fhr) or Plume(buoys, fhr)
+    new = [d for d in cycles if runtime(d) not in plume.runtimes]
+    try:
+        for data in new:
+            plume.add(data)
+    except ValueError:
+        log.info("Rebuilding the plume from %d cycles" % (len(cycles)))
+        plume, new = Plume(buoys, fhr), cycles
+        for data in new:
+            plume.add(data)
+    if start is not None:
+        plume.prune(start)
+    if new:
+        plume.save(path)
+    return plume
+
+def export(plume, out_dir=None):
+    """Write each station's plume to out_dir/STN_plume.csv"""
+    out_dir = out_dir or PLUME_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    for stn_id in plume.stations:
+        plume.station(stn_id).to_csv("%s/%s_plume.csv" % (out_dir, stn_id),
+                                     float_format='%.3f')
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-o', '--output', dest='output', help="Output directory")
+    args = ap.parse_args()
+
+    NOW = datetime.now()
+    start = NOW - timedelta(days=NUM_DAYS)
+    plume = update([load_points(f, fhr=FHR) for f in find_files(start, NOW)], start)
+    export(plume, args.output)
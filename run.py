@@ -1,43 +1,165 @@
+"""
+Automate the full pipeline: NDBC downloads, WW3 downloads, plotting and uploads. Every
+stage runs within this one long-lived process, so the imports, the multiprocessing
+pool, the Google Drive session, the grid index, decoded model series and parsed buoy
+data are all kept in memory between jobs.
+
+The pipeline is event driven. NOMADS and NDBC are polled frequently with cheap
+requests, and a newly validated model cycle or a changed buoy file immediately queues
+a render. Only stations whose inputs changed are re-rendered (see plots.main), and only
+those images are uploaded. Renders requested while one is running are coalesced into a
+single follow-up render.
+
+    python run.py
+"""
+import matplotlib
+matplotlib.use('Agg')
 import schedule
 import time
-import os
-SCRIPT_PATH = os.path.dirname(__file__) or "."
-import subprocess
-from cron_helper import logfile
+import sys
+import threading
+from multiprocessing import Pool
+from datetime import datetime, timedelta
+from cron_helper import logfile, lockfile
+log = logfile(f"cron.log")
 
-PYTHON = "/Users/leecarlaw/anaconda3/envs/ww3/bin/python"
+from configs import NUM_DAYS, MAX_CONNECTIONS, BUOY_POLL, WW3_POLL
+import get_buoys
+import get_ww3
+import extract
+import archive
+import plots
+import uploader
+import telemetry
 
-def execute(arg):
-    process = subprocess.Popen(arg, shell=True, stdout=subprocess.PIPE,
-              stderr=subprocess.PIPE)
-    process.communicate()
-    return process
+# Number of processes used to read WW3 data
+NPROC = 8
 
-def make_plots():
-    arg = f"{PYTHON} {SCRIPT_PATH}/get_buoys.py"
-    log.info(f"Executing {arg}...")
-    p = execute(arg)
+class Pipeline(object):
+    """State kept between jobs"""
+    def __init__(self, nproc=NPROC):
+        self.pool = Pool(nproc)
+        self.session = get_buoys.make_session()
+        self.drive = None
 
-    arg = f"{PYTHON} {SCRIPT_PATH}/plots.py -np 8"
-    log.info(f"Executing {arg}...")
-    p = execute(arg)
+        # Shared by every NOMADS download, so they all count against the same
+        # connection and request-rate limits
+        self.nomads = get_ww3.make_session(MAX_CONNECTIONS)
 
-    arg = f"{PYTHON} {SCRIPT_PATH}/uploader.py {SCRIPT_PATH}/images/*.png"
-    log.info(f"Executing {arg}...")
-    p = execute(arg)
+        # Reasons for the next render, and the condition the render thread waits on
+        self.pending = set()
+        self.changed = threading.Condition()
 
-def download_ww3_data():
-    arg = f"{PYTHON} {SCRIPT_PATH}/get_ww3.py"
-    log.info(f"Downloading WWIII data...")
-    p = execute(arg)
+    def request_plots(self, reason):
+        """Queue a render. Any number of requests made while a render is running
+        result in one more render once it finishes.
+        """
+        with self.changed:
+            self.pending.add(reason)
+            self.changed.notify()
 
-log = logfile(f"cron.log")
-task = schedule.Scheduler()
-task.every().hour.at(":00").do(make_plots)
-task.every().hour.at(":30").do(make_plots)
-task.every().day.at("07:35").do(download_ww3_data)
-task.every().day.at("19:35").do(download_ww3_data)
-
-while True:
-    task.run_pending()
-    time.sleep(1)
+    def render_loop(self):
+        """Render (and upload) whenever plots are requested. Runs in its own thread."""
+        while True:
+            with self.changed:
+                while not self.pending:
+                    self.changed.wait()
+                reasons, self.pending = self.pending, set()
+            log.info("Plotting for: %s" % (", ".join(sorted(reasons))))
+            run_job(self.make_plots)
+
+    def make_plots(self):
+        now = datetime.now()
+        with lockfile('plots'), telemetry.stage('plots'):
+            images = plots.main(now - timedelta(days=NUM_DAYS), now, now=now,
+                                pool=self.pool)
+            cycles = uploader.read_cycles("%s/%s" % (plots.PLOT_DIR, plots.MANIFEST))
+
+        # Only the images that were regenerated need uploading
+        if images:
+            log.info("Uploading images...")
+            self.drive = uploader.authorize(self.drive)
+            uploader.upload_files(self.drive, images)
+            telemetry.cycles_uploaded(cycles)
+
+    def poll_buoys(self):
+        """Conditional requests for every station. Plots are only requested if any
+        station's file changed.
+        """
+        changed = get_buoys.get_buoys(session=self.session)
+        if changed:
+            self.request_plots("buoys %s" % (" ".join(changed)))
+
+    def poll_ww3(self):
+        """Probe NOMADS for any missing cycles, downloading those that are ready"""
+        files = get_ww3.backfill(session=self.nomads)
+        if files:
+            self.ingest(files)
+            self.request_plots("model %s" % (" ".join(files)))
+            self.make_maps(max(files, key=archive.cycle_time))
+
+    def make_maps(self, filename):
+        """Render the map loop of the newest cycle and upload it"""
+        with lockfile('maps'):
+            images = plots.make_maps(filename, pool=self.pool)
+        self.drive = uploader.authorize(self.drive)
+        uploader.upload_files(self.drive, images[-1:])
+
+    def ingest(self, files):
+        """Pull the buoy-point series out of new cycles once, rather than on every
+        plot, and append their fields to the consolidated archive.
+        """
+        for fname in files:
+            extract.load_points(fname)
+        archive.append_cycles(files)
+
+def run_job(job):
+    """Run a job, logging rather than raising any errors so the scheduler keeps going.
+    The job is timed as a telemetry stage, and the metrics are flushed once it's done.
+    """
+    try:
+        with telemetry.stage(job.__name__):
+            job()
+    except Exception:
+        log.exception(f"{job.__name__} failed")
+    finally:
+        telemetry.flush()
+
+# One lock per threaded job, so a slow run is never overlapped by the next
+_running = {}
+
+def run_threaded(job):
+    """Downloads can take minutes, so they run in the background to keep the other
+    jobs on schedule. A job still running from its last call is skipped.
+    """
+    lock = _running.setdefault(job.__name__, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return
+    def run():
+        try:
+            run_job(job)
+        finally:
+            lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+if __name__ == '__main__':
+    with lockfile('run', blocking=False) as locked:
+        if not locked:
+            log.error("run.py is already running")
+            sys.exit(1)
+
+        telemetry.init("run")
+        pipeline = Pipeline()
+        threading.Thread(target=pipeline.render_loop, daemon=True).start()
+
+        task = schedule.Scheduler()
+        task.every(WW3_POLL).seconds.do(run_threaded, pipeline.poll_ww3)
+        task.every(BUOY_POLL).seconds.do(run_threaded, pipeline.poll_buoys)
+
+        # The NOW reference line moves every NOW_GRANULARITY minutes
+        task.every().hour.at(":00").do(pipeline.request_plots, "clock")
+        pipeline.request_plots("startup")
+
+        while True:
+            task.run_pending()
+            time.sleep(1)
@@ -0,0 +1,339 @@
+"""
+Local HTTP service for the station time series and images, as JSON, csv, PNG or WebP.
+Every response is built ahead of time and held in memory, so requests never read the
+GRIB2, text or image files. A watcher thread checks the inputs every HTTP_POLL seconds
+and rebuilds the responses when a new cycle, buoy observation or image lands.
+
+Responses carry an ETag, so clients revalidating with If-None-Match get a 304 without a
+body, and JSON and csv bodies are gzipped for clients that accept it.
+
+    python server.py
+    python server.py -p 8050
+
+Endpoints:
+    /stations                       Station metadata
+    /stations/STN/obs.json          Observations within the last NUM_DAYS (or .csv)
+    /stations/STN/model.json        Model series of each cycle (or .csv)
+    /stations/STN/plume.json        Forecast plume (see plume.py) (or .csv)
+    /images/NAME                    Latest images, e.g. STN.png, STN_thumb.webp, map.gif
+    /health                         When the responses were last built
+
+JSON tables are in pandas' 'split' orientation, and can be read back with
+pandas.read_json(url, orient='split').
+"""
+import matplotlib
+matplotlib.use('Agg')
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+import pandas as pd
+import mimetypes
+import threading
+import argparse
+import hashlib
+import gzip
+import json
+import time
+import os
+
+from configs import BUOYS, DATA_DIR, PLOT_DIR, FHR, NUM_DAYS
+from configs import HTTP_HOST, HTTP_PORT, HTTP_POLL
+from cron_helper import logfile
+log = logfile("server.log")
+from extract import load_points, find_files, prune_points
+from ndbc import store_name, update_station
+from plots import read_buoy_data, output_files
+from plume import Plume, PLUME
+import telemetry
+
+mimetypes.add_type('image/webp', '.webp')
+
+# Content types worth compressing, and the smallest body that is
+COMPRESSIBLE = ['application/json', 'text/csv']
+MIN_GZIP = 512
+
+class Response(object):
+    """A response body held in memory, with its ETag and gzipped copy"""
+    __slots__ = ['body', 'gzipped', 'etag', 'content_type']
+
+    def __init__(self, body, content_type):
+        if isinstance(body, str):
+            body = body.encode()
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % (hashlib.sha1(body).hexdigest())
+        self.gzipped = None
+        if content_type.split(';')[0] in COMPRESSIBLE and len(body) >= MIN_GZIP:
+            self.gzipped = gzip.compress(body, compresslevel=6, mtime=0)
+
+def json_response(data):
+    return Response(json.dumps(data, default=str), 'application/json')
+
+def table_responses(frame, name):
+    """JSON and csv responses for a table, keyed on name.json and name.csv"""
+    return {
+        "%s.json" % (name): Response(frame.to_json(orient='split', index=False,
+                                                   date_format='iso',
+                                                   double_precision=3),
+                                     'application/json'),
+        "%s.csv" % (name): Response(frame.to_csv(index=False, float_format='%.3f'),
+                                    'text/csv; charset=utf-8'),
+    }
+
+def obs_frame(buoy_data):
+    """Observations of a station (see plots.read_buoy_data) as a table"""
+    columns = ['wvhgt', 'wspd', 'wspd_adj', 'u', 'v']
+    if not buoy_data:
+        return pd.DataFrame(columns=['time'] + columns)
+    frame = pd.DataFrame(dict((name, buoy_data[name]) for name in columns))
+    frame.insert(0, 'time', buoy_data['time'])
+    return frame.sort_values('time', ignore_index=True)
+
+def model_frame(arr, stn_id):
+    """Model series of a station for each cycle as one table, oldest cycle first"""
+    frames = [pd.DataFrame({'runtime': pd.Timestamp(d['runtime']),
+                            'time': pd.DatetimeIndex(d['time']),
+                            'wvhgt': d['wvhgt'][stn_id], 'wspd': d['wspd'][stn_id]})
+              for d in arr]
+    if not frames:
+        return pd.DataFrame(columns=['runtime', 'time', 'wvhgt', 'wspd'])
+    return pd.concat(frames, ignore_index=True)
+
+def build(files, start, data_dir=DATA_DIR, plot_dir=PLOT_DIR, plume_path=None,
+          buoys=BUOYS):
+    """Build every response.
+
+    Parameters
+    ----------
+    files : list
+        WW3 grib2 files to serve the model series of. Their series come from the
+        extract.py sidecars (or this process's cache of them).
+    start : datetime
+        Only serve observations from start onwards
+
+    Returns
+    -------
+    responses : dict
+        Request path -> Response
+    """
+    # Drop the cached series of cycles that have left the window, so memory doesn't
+    # grow with every cycle
+    prune_points(files)
+    arr = [load_points(f, buoys, fhr=FHR) for f in files]
+    plume = Plume.load(plume_path, buoys, FHR)
+
+    responses = {}
+    stations = []
+    for stn_id, (lat, lon, height) in buoys.items():
+        prefix = "/stations/%s" % (stn_id)
+        tables = {
+            'obs': obs_frame(read_buoy_data(data_dir, stn_id, start)),
+            'model': model_frame(arr, stn_id),
+        }
+        if plume is not None:
+            tables['plume'] = plume.station(stn_id).reset_index()
+        for name, frame in tables.items():
+            for fname, response in table_responses(frame, name).items():
+                responses["%s/%s" % (prefix, fname)] = response
+
+        images = []
+        for image in output_files("%s/%s" % (plot_dir, stn_id)):
+            name = os.path.basename(image)
+            if read_image(image, name, responses):
+                images.append("/images/%s" % (name))
+        stations.append({'id': stn_id, 'lat': lat, 'lon': lon, 'height': height,
+                         'tables': ["%s/%s.%s" % (prefix, name, ext) for name in tables
+                                    for ext in ['json', 'csv']],
+                         'images': images})
+
+    read_image("%s/map/map.gif" % (plot_dir), 'map.gif', responses)
+    responses['/stations'] = json_response(stations)
+    responses['/health'] = json_response({
+        'built': datetime.now().isoformat(),
+        'cycles': [str(pd.Timestamp(d['runtime'])) for d in arr],
+        'stations': len(stations),
+    })
+    return responses
+
+def read_image(fname, name, responses):
+    """Add an image to responses under /images/name. False if it doesn't exist."""
+    try:
+        with open(fname, 'rb') as f:
+            body = f.read()
+    except OSError:
+        return False
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    responses["/images/%s" % (name)] = Response(body, content_type)
+    return True
+
+def input_files(files, data_dir=DATA_DIR, plot_dir=PLOT_DIR, plume_path=None,
+                buoys=BUOYS):
+    """Every file the responses are built from"""
+    inputs = list(files)
+    for stn_id in buoys:
+        inputs.extend(["%s/%s.txt" % (data_dir, stn_id), store_name(data_dir, stn_id)])
+        inputs.extend(output_files("%s/%s" % (plot_dir, stn_id)))
+    inputs.extend(["%s/map/map.gif" % (plot_dir), plume_path or PLUME])
+    return inputs
+
+def stat_fingerprint(fnames):
+    """Hash of the size and modification time of each file, or of its absence"""
+    stats = []
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+            stats.append([fname, st.st_size, st.st_mtime_ns])
+        except OSError:
+            stats.append([fname, None, None])
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+class Service(object):
+    """The responses currently being served, and the fingerprint of the inputs they
+    were built from. Requests only ever look up the current dictionary of responses,
+    which is replaced whole when the inputs change.
+    """
+    def __init__(self, data_dir=DATA_DIR, plot_dir=PLOT_DIR, plume_path=None,
+                 days=NUM_DAYS, buoys=BUOYS):
+        self.data_dir = data_dir
+        self.plot_dir = plot_dir
+        self.plume_path = plume_path
+        self.days = days
+        self.buoys = buoys
+        self.responses = {}
+        self.fingerprint = None
+        self.refreshing = threading.Lock()
+
+    def get(self, path):
+        return self.responses.get(path)
+
+    def refresh(self, now=None):
+        """Rebuild the responses if any of their inputs have changed since the last
+        build. Only the file metadata is read otherwise.
+
+        Returns
+        -------
+        rebuilt : bool
+        """
+        now = now or datetime.now()
+        start = now - timedelta(days=self.days)
+        with self.refreshing:
+            # Bring the observation stores up to date first, so that building from
+            # them doesn't itself change the fingerprint
+            for stn_id in self.buoys:
+                update_station(self.data_dir, stn_id)
+            files = find_files(start, now)
+            fingerprint = stat_fingerprint(input_files(files, self.data_dir,
+                                                       self.plot_dir, self.plume_path,
+                                                       self.buoys))
+            # The observation window moves even when no file changes
+            fingerprint += start.strftime('%Y%m%d%H')
+            if fingerprint == self.fingerprint:
+                return False
+
+            t1 = time.perf_counter()
+            self.responses = build(files, start, self.data_dir, self.plot_dir,
+                                   self.plume_path, self.buoys)
+            self.fingerprint = fingerprint
+            delta = time.perf_counter() - t1
+            log.info("Built %d responses in %.2f seconds" % (len(self.responses), delta))
+            telemetry.count('cache_rebuilds', stage='server')
+            return True
+
+    def watch(self, interval=HTTP_POLL):
+        """Refresh every interval seconds. Runs in its own thread."""
+        while True:
+            time.sleep(interval)
+            try:
+                if self.refresh():
+                    telemetry.flush()
+            except Exception:
+                log.exception("Refreshing the responses failed")
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header matches an ETag (weakly, as RFC 7232 asks)"""
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag
+                                   for tag in tags]
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers GET and HEAD requests from the service's responses"""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ww3'
+
+    # Headers and body are written separately, which Nagle's algorithm would otherwise
+    # delay on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def respond(self, head):
+        path = self.path.split('?', 1)[0]
+        if len(path) > 1:
+            path = path.rstrip('/')
+        response = self.server.service.get(path)
+        if response is None:
+            response = Response('{"error": "not found"}', 'application/json')
+            self.send(404, response, response.body, head)
+            return
+
+        # The gzipped body is a different representation, so it gets its own ETag
+        body, etag = response.body, response.etag
+        gzipped = response.gzipped is not None and \
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body, etag = response.gzipped, response.etag[:-1] + '-gzip"'
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send(304, response, b'', True, etag)
+            return
+        self.send(200, response, body, head, etag, gzipped)
+
+    def send(self, status, response, body, head, etag=None, gzipped=False):
+        self.send_response(status)
+        if status != 304:
+            self.send_header('Content-Type', response.content_type)
+            self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            # Clients may keep a copy, but should revalidate it each time
+            self.send_header('Cache-Control', 'no-cache')
+        if response.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request would cost more than answering it
+        pass
+
+def serve(service, host=HTTP_HOST, port=HTTP_PORT):
+    """HTTP server answering from service, with a thread per connection. Call its
+    serve_forever to start answering requests.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--host', dest='host', default=HTTP_HOST, help="Address to listen on")
+    ap.add_argument('-p', '--port', dest='port', type=int, default=HTTP_PORT,
+                    help="Port to listen on")
+    args = ap.parse_args()
+
+    telemetry.init('server')
+    service = Service()
+    service.refresh()
+    threading.Thread(target=service.watch, daemon=True).start()
+    server = serve(service, args.host, args.port)
+    log.info("Serving on %s:%d" % (args.host, args.port))
+    print("Serving on http://%s:%d/stations" % (args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,202 @@
+"""
+Runtime telemetry shared by each stage of the pipeline. Provides stage timers,
+counters (bytes downloaded, GRIB records, retries, files skipped, images rendered) and
+peak-RSS gauges. Every measurement is appended as a JSON line to logs/telemetry.jsonl,
+and the current values are written to logs/<job>.prom for the Prometheus node_exporter
+textfile collector.
+
+Also tracks the latency of each model cycle, from when it is first seen on NOMADS to
+when its images are uploaded.
+
+    import telemetry
+    telemetry.init("plots")
+    with telemetry.stage("render"):
+        ...
+    telemetry.count("images_rendered", 5)
+    telemetry.flush()
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import resource
+import json
+import time
+import os
+from cron_helper import locked
+SCRIPT_PATH = os.path.dirname(__file__) or "."
+
+LOG_DIR = f"{SCRIPT_PATH}/logs"
+EVENTS = f"{LOG_DIR}/telemetry.jsonl"
+CYCLES = f"{LOG_DIR}/cycles.json"
+PREFIX = "ww3_"
+
+# Cycles older than this (seconds) are dropped from the latency state
+CYCLE_RETENTION = 10 * 86400
+
+# The event log is rotated to telemetry.jsonl.1, .2, ... once it passes this size
+# (bytes), keeping this many old logs
+EVENTS_MAX_BYTES = 10 * 1024 ** 2
+EVENTS_BACKUPS = 3
+
+_lock = threading.Lock()
+_job = "ww3"
+_counters = {}
+_gauges = {}
+
+def init(job):
+    """Set the job name, used to label events and name the Prometheus file"""
+    global _job
+    _job = job
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024. ** 2 if os.uname().sysname == 'Darwin' else rss / 1024.
+
+def _size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+def rotate_events(max_bytes=EVENTS_MAX_BYTES, backups=EVENTS_BACKUPS):
+    """Rotate the event log if it has grown past max_bytes. Every job appends to the
+    same log, so the size is checked again under a file lock before rotating.
+    """
+    if _size(EVENTS) < max_bytes:
+        return
+    with locked(EVENTS + '.lock'):
+        if _size(EVENTS) < max_bytes:
+            return
+        for n in range(backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (EVENTS, n)):
+                os.replace("%s.%d" % (EVENTS, n), "%s.%d" % (EVENTS, n + 1))
+        if backups > 0:
+            os.replace(EVENTS, EVENTS + '.1')
+        else:
+            os.remove(EVENTS)
+
+def event(name, **fields):
+    """Append a single event to the JSON-lines log, rotating it if it's too large"""
+    record = {'time': datetime.utcnow().isoformat(), 'job': _job, 'pid': os.getpid(),
+              'event': name}
+    record.update(fields)
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        rotate_events()
+        with open(EVENTS, 'a') as f:
+            f.write(line)
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def count(name, value=1, **labels):
+    """Increment a counter"""
+    if not value: return
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    """Set a gauge"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+@contextmanager
+def stage(name, **labels):
+    """Time a pipeline stage. Emits a stage event with its duration, status and the
+    process peak RSS, and updates the stage gauges.
+    """
+    t0 = time.time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        seconds = time.time() - t0
+        rss = peak_rss_mb()
+        event('stage', stage=name, seconds=seconds, status=status, peak_rss_mb=rss,
+              **labels)
+        gauge('stage_seconds', seconds, stage=name, **labels)
+        gauge('peak_rss_megabytes', rss)
+        count('stage_runs_total', stage=name, status=status)
+        if status == 'ok':
+            gauge('stage_last_success_timestamp_seconds', time.time(), stage=name)
+
+def _format(name, labels, value):
+    if labels:
+        labels = ",".join('%s="%s"' % (k, v) for k, v in labels)
+        return "%s%s{%s} %s\n" % (PREFIX, name, labels, value)
+    return "%s%s %s\n" % (PREFIX, name, value)
+
+def flush():
+    """Write the current counters and gauges to the Prometheus textfile"""
+    with _lock:
+        lines = []
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(_format(name, labels, value))
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(_format(name, labels, value))
+    fname = "%s/%s.prom" % (LOG_DIR, _job)
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp, fname)
+
+# --------------------------------------------------------------------------------------
+# Cycle latency tracking. State is shared between processes through logs/cycles.json
+# --------------------------------------------------------------------------------------
+def _update_cycles(func):
+    # get_ww3.py, uploader.py and run.py all update the file, possibly at once
+    with _lock, locked(CYCLES + '.lock'):
+        try:
+            with open(CYCLES) as f:
+                cycles = json.load(f)
+        except (OSError, ValueError):
+            cycles = {}
+        result = func(cycles)
+        cutoff = time.time() - CYCLE_RETENTION
+        cycles = dict((k, v) for k, v in cycles.items() if v['seen'] > cutoff)
+        tmp = "%s.%d.tmp" % (CYCLES, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cycles, f, indent=1)
+        os.replace(tmp, CYCLES)
+    return result
+
+def cycle_seen(cycle):
+    """Record the first time a model cycle (YYYY-MM-DD/HH) was found on NOMADS"""
+    def update(cycles):
+        if cycle not in cycles:
+            cycles[cycle] = {'seen': time.time()}
+            return True
+        return False
+    if _update_cycles(update):
+        event('cycle_seen', cycle=cycle)
+
+def cycle_downloaded(cycle):
+    """Record the time a model cycle finished downloading"""
+    def update(cycles):
+        cycles.setdefault(cycle, {'seen': time.time()})['downloaded'] = time.time()
+    _update_cycles(update)
+    event('cycle_downloaded', cycle=cycle)
+
+def cycles_uploaded(uploaded):
+    """Mark the cycles (YYYY-MM-DD/HH) that the uploaded images were drawn from as
+    delivered, and record the latency of each from first seen on NOMADS to image
+    upload. Cycles already delivered, or never downloaded, are left alone.
+    """
+    now = time.time()
+    def update(cycles):
+        delivered = []
+        for cycle in set(uploaded):
+            state = cycles.get(cycle)
+            if state is not None and 'downloaded' in state and 'uploaded' not in state:
+                state['uploaded'] = now
+                delivered.append((cycle, now - state['seen']))
+        return delivered
+    for cycle, latency in _update_cycles(update):
+        event('cycle_uploaded', cycle=cycle, latency_seconds=latency)
+        gauge('cycle_latency_seconds', latency)
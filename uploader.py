@@ -1,43 +1,170 @@
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
+"""
+Sync images (or any other files) to a Google Drive folder. The folder is listed once,
+files whose MD5 matches the copy already on Drive are skipped, and the rest are
+uploaded concurrently.
+
+    python uploader.py images/*.png logs/*.log
+    python uploader.py -m images/manifest.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import argparse
+import hashlib
+import json
+import time
+import os
+
+import telemetry
 
 FOLDER = '1PdbtaISRJxTEyEpOzfvP-BmgfyjUuetX'
+CREDENTIALS = "credentials.txt"
+
+# Number of concurrent uploads, and attempts per file before giving up
+UPLOAD_THREADS = 4
+RETRIES = 3
+
+def authorize(drive=None, credentials=CREDENTIALS):
+    """Return an authorized GoogleDrive. An existing drive is reused, and its token is
+    only refreshed once expired, so a long-running process authenticates once.
+    """
+    from pydrive.auth import GoogleAuth
+    from pydrive.drive import GoogleDrive
+
+    if drive is not None:
+        if drive.auth.access_token_expired:
+            drive.auth.Refresh()
+            drive.auth.SaveCredentialsFile(credentials)
+        return drive
 
-def upload_to_google_drive(file, short_name):
+    gauth = GoogleAuth()
+    gauth.LoadCredentialsFile(credentials)
+    if gauth.credentials is None:
+        gauth.CommandLineAuth()
+    elif gauth.access_token_expired:
+        gauth.Refresh()
+    else:
+        gauth.Authorize()
+    gauth.SaveCredentialsFile(credentials)
+    return GoogleDrive(gauth)
+
+def md5sum(fname):
+    """MD5 checksum of a local file, as reported by Drive's md5Checksum"""
+    h = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def list_folder(drive, folder=FOLDER):
+    """List the folder a single time.
+
+    Returns
+    -------
+    files : dict
+        title -> (id, md5Checksum) for each file in the folder
+    """
     file_list = drive.ListFile({'q':"'%s' in parents and trashed=False" %
-                               (FOLDER)}).GetList()
-    for file1 in file_list:
-        if file1['title'] == short_name:
-            id = file1['id']
-    try:
-        print("Updating an EXISTING FILE...")
-        f = drive.CreateFile({'title': short_name, 'id':id})
-        f.SetContentFile(file)
-        f.Upload()
-    except:
-        print("This is a NEW FILE...")
-        f = drive.CreateFile({'title': short_name, 'parents': [{'id': FOLDER}]})
-        f.SetContentFile(file)
-        f.Upload()
-
-# Parse the passed arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("files", help="List files to be uploaded.", nargs="+")
-
-# Start authentication
-gauth = GoogleAuth()
-gauth.LoadCredentialsFile("credentials.txt")
-if gauth.credentials is None:
-    gauth.CommandLineAuth()
-elif gauth.access_token_expired:
-    gauth.Refresh()
-else:
-    gauth.Authorize()
-gauth.SaveCredentialsFile("credentials.txt")
-drive = GoogleDrive(gauth)
-
-# Upload the files
-for f in parser.parse_args().files:
-    short_name = f[f.rfind('/')+1:]
-    upload_to_google_drive(f, short_name)
+                               (folder)}).GetList()
+    return dict((f['title'], (f['id'], f.get('md5Checksum'))) for f in file_list)
+
+def upload_file(drive, fname, title, file_id=None, folder=FOLDER, http=None):
+    """Upload a single file, updating file_id if given and creating a new file in
+    folder otherwise. Failed uploads are retried with exponential backoff.
+    """
+    if file_id is not None:
+        metadata = {'title': title, 'id': file_id}
+    else:
+        metadata = {'title': title, 'parents': [{'id': folder}]}
+    param = {'http': http} if http is not None else None
+
+    for attempt in range(RETRIES):
+        try:
+            f = drive.CreateFile(metadata)
+            f.SetContentFile(fname)
+            f.Upload(param=param)
+            return
+        except Exception:
+            if attempt == RETRIES - 1:
+                raise
+            telemetry.count('retries', stage='upload')
+            time.sleep(2 ** attempt)
+
+@telemetry.stage('upload')
+def upload_files(drive, files, folder=FOLDER, nthreads=UPLOAD_THREADS):
+    """Sync files to folder. Files whose MD5 matches the copy on Drive are skipped.
+
+    Parameters
+    ----------
+    drive : pydrive.drive.GoogleDrive
+        Authorized Drive client, or anything providing the same ListFile/CreateFile
+        interface
+    files : list
+        Local files to upload
+    folder : str
+        Drive folder ID
+    nthreads : int
+        Number of concurrent uploads
+
+    Returns
+    -------
+    uploaded : list
+        Files that were uploaded
+    """
+    existing = list_folder(drive, folder)
+    uploads = []
+    for fname in files:
+        title = os.path.basename(fname)
+        file_id, checksum = existing.get(title, (None, None))
+        if checksum is not None and checksum == md5sum(fname):
+            continue
+        uploads.append((fname, title, file_id))
+    telemetry.count('files_skipped', len(files) - len(uploads), stage='upload')
+
+    # httplib2 connections aren't thread-safe, so each thread gets its own
+    local = threading.local()
+    def upload(job):
+        fname, title, file_id = job
+        http = None
+        if hasattr(drive, 'auth') and hasattr(drive.auth, 'Get_Http_Object'):
+            if not hasattr(local, 'http'):
+                local.http = drive.auth.Get_Http_Object()
+            http = local.http
+        print("%s %s..." % ("Updating" if file_id else "Creating", title))
+        upload_file(drive, fname, title, file_id, folder, http)
+        return fname
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        uploaded = list(executor.map(upload, uploads))
+    telemetry.count('files_uploaded', len(uploaded))
+    return uploaded
+
+def read_manifest(fname):
+    """Images listed in a plots.py manifest"""
+    with open(fname) as f:
+        return json.load(f)['images']
+
+def read_cycles(fname):
+    """Model cycles the images of a plots.py manifest were drawn from"""
+    with open(fname) as f:
+        return json.load(f).get('cycles', [])
+
+if __name__ == '__main__':
+    # Parse the passed arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", help="List files to be uploaded.", nargs="*")
+    parser.add_argument("-m", "--manifest", dest="manifest",
+                        help="Upload the images listed in a plots.py manifest")
+    args = parser.parse_args()
+
+    files = list(args.files)
+    cycles = []
+    if args.manifest:
+        files.extend(read_manifest(args.manifest))
+        cycles = read_cycles(args.manifest)
+
+    # Start authentication and upload the files
+    telemetry.init('uploader')
+    drive = authorize()
+    upload_files(drive, files)
+    telemetry.cycles_uploaded(cycles)
+    telemetry.flush()
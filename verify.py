@@ -0,0 +1,259 @@
+"""
+Forecast verification. Every buoy observation is paired with the forecast from each
+model cycle valid at (nearly) the same time, and bias, MAE, RMSE and threshold hit
+rates are computed by lead-time bucket, station and season for significant wave height
+and 10-m (log-wind adjusted) wind speed.
+
+    python verify.py -s 2020-10-01 -e 2020-10-31
+    python verify.py -s 2020-10-01 -e 2020-10-31 -a -np 8
+
+Tables are written as csv files to PLOT_DIR/verification.
+"""
+from multiprocessing import Pool
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import argparse
+import os
+
+from configs import M2FT, MS2KT, BUOYS, DATA_DIR, PLOT_DIR, NUM_DAYS
+from cron_helper import logfile
+log = logfile("verify.log")
+from extract import load_points, find_files
+from archive import load_cycles
+from ndbc import update_station
+from plots import log_wind
+
+VERIFY_DIR = f"{PLOT_DIR}/verification"
+
+# Maximum difference (minutes) between an observation and the forecast valid time
+TOLERANCE = 30
+
+# Lead-time buckets (hours). Bucket edges are inclusive on the right.
+LEAD_BUCKETS = [-1, 12, 24, 48, 84, 149]
+
+# Exceedance thresholds for the hit rates. Wave heights in ft, wind speeds in kts.
+THRESHOLDS = {
+    'wvhgt': [2., 4., 6.],
+    'wspd': [15., 22., 34.],
+}
+
+SEASONS = np.array(['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA', 'SON',
+                    'SON', 'SON', 'DJF'])
+
+# Groupings of the summary tables
+GROUPS = {
+    'lead': ['lead_bucket'],
+    'station': ['station'],
+    'season': ['season'],
+    'station_lead': ['station', 'lead_bucket'],
+}
+
+def read_obs(data_dir, stn_id, start=None):
+    """Observed wave heights (ft) and 10-m adjusted wind speeds (kts) for a station.
+
+    Returns
+    -------
+    obs : dict or None
+        'time' (datetime64[m]) and each verified variable
+    """
+    store = update_station(data_dir, stn_id)
+    if store is None:
+        return None
+    keep = slice(None)
+    if start is not None:
+        keep = store['time'] >= np.datetime64(start, 'm')
+    return {
+        'time': store['time'][keep],
+        'wvhgt': store['WVHT'][keep] * M2FT,
+        'wspd': log_wind(store['WSPD'][keep] * MS2KT, BUOYS[stn_id][-1]),
+    }
+
+def match_times(obs_time, valid, tolerance=TOLERANCE):
+    """Nearest observation to each forecast valid time.
+
+    Parameters
+    ----------
+    obs_time : np.array
+        Sorted observation times (datetime64)
+    valid : np.array
+        Forecast valid times (datetime64)
+    tolerance : int
+        Maximum time difference in minutes
+
+    Returns
+    -------
+    idx : np.array
+        Index into obs_time of the nearest observation, -1 where none is within
+        tolerance
+    """
+    idx = np.full(len(valid), -1, dtype=np.int64)
+    if len(obs_time) == 0:
+        return idx
+    obs_time = obs_time.astype('datetime64[m]')
+    valid = valid.astype('datetime64[m]')
+    right = np.clip(np.searchsorted(obs_time, valid), 1, len(obs_time) - 1)
+    left = right - 1
+    if len(obs_time) == 1:
+        left = right = np.zeros(len(valid), dtype=np.int64)
+    dt_left = np.abs(valid - obs_time[left])
+    dt_right = np.abs(obs_time[right] - valid)
+    nearest = np.where(dt_right < dt_left, right, left)
+    dt = np.minimum(dt_left, dt_right)
+    ok = dt <= np.timedelta64(tolerance, 'm')
+    idx[ok] = nearest[ok]
+    return idx
+
+def pair_station(stn_id, cycles, obs, tolerance=TOLERANCE):
+    """Pair one station's observations with every forecast in cycles.
+
+    Parameters
+    ----------
+    stn_id : str
+        Station id
+    cycles : list
+        Model series for each cycle, as returned by extract.load_points
+    obs : dict
+        Observations, as returned by read_obs
+
+    Returns
+    -------
+    pairs : pd.DataFrame
+        One row per matched forecast and observation
+    """
+    valid = np.concatenate([np.asarray(d['time'], dtype='datetime64[m]')
+                            for d in cycles])
+    runtime = np.repeat([np.datetime64(d['runtime'], 'm') for d in cycles],
+                        [len(d['time']) for d in cycles])
+    lead = (valid - runtime) // np.timedelta64(1, 'h')
+
+    frames = []
+    for var in THRESHOLDS:
+        fcst = np.concatenate([d[var][stn_id] for d in cycles])
+        observed = ~np.isnan(obs[var])
+        obs_time, obs_val = obs['time'][observed], obs[var][observed]
+        idx = match_times(obs_time, valid, tolerance)
+        ok = (idx >= 0) & ~np.isnan(fcst)
+        frames.append(pd.DataFrame({
+            'var': var,
+            'station': stn_id,
+            'runtime': runtime[ok],
+            'valid': valid[ok],
+            'lead': lead[ok],
+            'fcst': fcst[ok].astype(np.float64),
+            'obs': obs_val[idx[ok]].astype(np.float64),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+def pair_all(cycles, buoys=BUOYS, data_dir=DATA_DIR, tolerance=TOLERANCE):
+    """Pair the observations of every station with every forecast in cycles"""
+    frames = [pd.DataFrame(columns=['var', 'station', 'runtime', 'valid', 'lead',
+                                    'fcst', 'obs'])]
+    start = min([d['runtime'] for d in cycles], default=None)
+    for stn_id in buoys if cycles else []:
+        obs = read_obs(data_dir, stn_id, start)
+        if obs is None:
+            log.warning(f"No observations for {stn_id}")
+            continue
+        frames.append(pair_station(stn_id, cycles, obs, tolerance))
+    pairs = pd.concat(frames, ignore_index=True).astype({'lead': np.int64,
+                                                         'fcst': np.float64,
+                                                         'obs': np.float64})
+    pairs['lead_bucket'] = pd.cut(pairs['lead'], LEAD_BUCKETS).astype(str)
+    pairs['season'] = SEASONS[pd.DatetimeIndex(pairs['valid']).month - 1]
+    return pairs
+
+def summarize(pairs, by, thresholds):
+    """Verification statistics for a single variable.
+
+    Parameters
+    ----------
+    pairs : pd.DataFrame
+        Paired forecasts and observations of one variable, from pair_all
+    by : list
+        Columns to group by
+    thresholds : list
+        Exceedance thresholds for the hit rates
+
+    Returns
+    -------
+    stats : pd.DataFrame
+        n, bias, mae and rmse, and the probability of detection (pod), false alarm
+        ratio (far) and critical success index (csi) of each threshold
+    """
+    err = pairs['fcst'] - pairs['obs']
+    cols = {'n': np.ones(len(pairs)), 'err': err, 'abs': err.abs(), 'sq': err ** 2}
+    for thr in thresholds:
+        f, o = pairs['fcst'] >= thr, pairs['obs'] >= thr
+        cols['hit_%g' % thr] = f & o
+        cols['miss_%g' % thr] = ~f & o
+        cols['fa_%g' % thr] = f & ~o
+    sums = pd.DataFrame(cols).groupby([pairs[c] for c in by]).sum()
+
+    stats = pd.DataFrame({'n': sums['n'].astype(int)})
+    stats['bias'] = sums['err'] / sums['n']
+    stats['mae'] = sums['abs'] / sums['n']
+    stats['rmse'] = np.sqrt(sums['sq'] / sums['n'])
+    for thr in thresholds:
+        hit, miss, fa = [sums['%s_%g' % (k, thr)] for k in ['hit', 'miss', 'fa']]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['pod_%g' % thr] = hit / (hit + miss)
+            stats['far_%g' % thr] = fa / (hit + fa)
+            stats['csi_%g' % thr] = hit / (hit + miss + fa)
+    return stats.reset_index()
+
+def verify(cycles, buoys=BUOYS, data_dir=DATA_DIR, groups=GROUPS):
+    """Verify every cycle against the buoy observations.
+
+    Returns
+    -------
+    tables : dict
+        (var, group name) -> summary table, for each variable in THRESHOLDS and each
+        grouping in groups
+    """
+    pairs = pair_all(cycles, buoys, data_dir)
+    log.info(f"Paired {len(pairs)} forecasts from {len(cycles)} cycles")
+    tables = {}
+    for var, thresholds in THRESHOLDS.items():
+        subset = pairs[pairs['var'] == var]
+        for name, by in groups.items():
+            tables[(var, name)] = summarize(subset, by, thresholds)
+    return tables
+
+def write_tables(tables, out_dir=None):
+    """Write each summary table to out_dir/VAR_GROUP.csv"""
+    out_dir = out_dir or VERIFY_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    for (var, name), stats in tables.items():
+        stats.to_csv("%s/%s_%s.csv" % (out_dir, var, name), index=False,
+                     float_format='%.4f')
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--start', dest="start", help="YYYY-MM-DD")
+    ap.add_argument('-e', '--end', dest="end", help="YYYY-MM-DD")
+    ap.add_argument('-a', '--archive', dest='archive', action='store_true',
+                    help="Read model data from the consolidated archive (archive.py)")
+    ap.add_argument('-np', '--nproc', dest='nproc', type=int,
+                    help="Number of processes to read grib2 files with")
+    ap.add_argument('-o', '--output', dest='output', help="Output directory")
+    args = ap.parse_args()
+
+    NOW = datetime.now()
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else \
+            NOW - timedelta(days=NUM_DAYS)
+    end = datetime.strptime(args.end, '%Y-%m-%d') if args.end else NOW
+
+    if args.archive:
+        cycles = load_cycles(start, end)
+    elif args.nproc:
+        with Pool(args.nproc) as pool:
+            cycles = pool.map(load_points, find_files(start, end))
+    else:
+        cycles = [load_points(f) for f in find_files(start, end)]
+
+    tables = verify(cycles)
+    write_tables(tables, args.output)
+    for var in THRESHOLDS:
+        print(var)
+        print(tables[(var, 'lead')].to_string(index=False))